@@ -26,6 +26,7 @@ setup(name="tiscam",
             "PyGObject",
             "PyQt5",
             "matplotlib",
+            "numpy",
             "toml",
             "vext",
             "vext.gi"],
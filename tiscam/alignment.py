@@ -0,0 +1,265 @@
+"""
+Alignment of the frames of all the cameras of a session.
+
+The cameras share the PWM trigger, so a frame is identified by its chunk
+and by the index of its trigger in the chunk. The chunks of the cameras
+are matched by their start time, as a camera started late or that missed a
+whole chunk has different chunk ids, then the frames by their trigger
+index, given by their frame index (chunks start at a multiple of
+pwm.chunk_size). Without trigger, frames are matched by their rank in the
+chunk, counting the drops estimated from the intervals.
+
+The aligned index table has one row per trigger seen by any camera and
+gives, for each camera, the chunk, the frame index, the position of the
+frame in its video file (-1 if the frame is missing) and its time. It is
+written to ALIGNMENT_FILE in the session directory and loaded with
+tiscam.timestamps.read_records. To print the skew between cameras, their
+drift in each chunk and the chunks where they disagree on the number of
+frames:
+
+    python -m tiscam.alignment -p path/to/session [-c configs.toml] [--clock running]
+"""
+import numpy as np
+from pathlib import Path
+
+from tiscam.analysis import load_session
+from tiscam.timestamps import RecordFile
+
+ALIGNMENT_FILE = "alignment.tsr"
+SKEW_PERCENTILES = [50, 99]
+CLOCKS = ["wall", "running"]
+
+
+def frame_times(cam, clock="wall"):
+    """Return the time (s) of each frame of a camera.
+
+    The running clock is the PTS clock of the pipeline, mapped to the wall
+    clock with the offset sampled at the end of each chunk, which removes
+    the jitter of the handoff from the times.
+    """
+    if clock == "wall":
+        return np.asarray(cam.wall, dtype=np.float64)
+    running = cam.frames["running_time"]
+    offset = cam.chunks["wall_minus_running"][cam.chunk_of_frame]
+    valid = (running >= 0) & np.isfinite(offset)
+    return np.where(valid, running / 1e9 + offset, cam.wall)
+
+
+def chunk_starts(cam, triggers, times):
+    "Return the estimated time of the first trigger of each chunk of a camera."
+    if len(cam.chunks) == 0:
+        return np.zeros(0)
+    first = cam.starts
+    return times[first] - triggers[first] * cam.chunk_period
+
+
+def default_tolerance(cameras, pause=0):
+    "Return the largest difference between the starts of a chunk on two cameras."
+    if pause > 0:
+        return pause / 2
+    gaps = [np.median(np.diff(cam.t0)) for cam in cameras if len(cam.chunks) > 1]
+    return min(gaps) / 2 if gaps else np.inf
+
+
+class SessionAlignment:
+    """Frames of the cameras of a session aligned by chunk and trigger.
+
+    :param cameras: CameraTimestamps of the cameras
+    :param clock: clock of the frame times, "wall" or "running"
+    :param tolerance: largest difference (s) between the starts of a chunk
+                      on two cameras, half the pause between chunks if None
+    :param pause: expected pause between two chunks (s), for the tolerance
+    """
+
+    def __init__(self, cameras, clock="wall", tolerance=None, pause=0):
+        "Match the chunks, then the frames of the cameras."
+        if clock not in CLOCKS:
+            raise ValueError(f"Unknown clock {clock}, available: {', '.join(CLOCKS)}")
+        self.cameras = [cam for cam in cameras if len(cam.chunks) > 0]
+        self.names = [cam.name for cam in self.cameras]
+        self.clock = clock
+        self.tolerance = default_tolerance(self.cameras, pause) if tolerance is None else tolerance
+        self.triggers = [cam.trigger for cam in self.cameras]
+        self.times = [frame_times(cam, clock) for cam in self.cameras]
+        self.match_chunks()
+        self.match_frames()
+        self.process()
+
+    def match_chunks(self):
+        "Group the chunks of all the cameras whose starts are within the tolerance."
+        starts = [chunk_starts(cam, trig, t) for cam, trig, t in zip(self.cameras, self.triggers, self.times)]
+        all_starts = np.concatenate(starts)
+        order = np.argsort(all_starts)
+        groups = np.empty(len(all_starts), dtype=np.int64)
+        groups[order] = np.cumsum(np.diff(all_starts[order], prepend=-np.inf) > self.tolerance) - 1
+        bounds = np.cumsum([0] + [len(s) for s in starts])
+        self.chunk_groups = [groups[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        self.n_groups = int(groups.max()) + 1
+
+        n_cams = len(self.cameras)
+        self.group_start = np.full(self.n_groups, np.inf)
+        np.minimum.at(self.group_start, groups, all_starts)
+        self.chunk_ids = np.full((self.n_groups, n_cams), -1, dtype=np.int64)
+        self.chunk_counts = np.zeros((self.n_groups, n_cams), dtype=np.int64)
+        self.duplicates = np.zeros(self.n_groups, dtype=np.int64)
+        for c, (cam, g) in enumerate(zip(self.cameras, self.chunk_groups)):
+            self.duplicates += np.bincount(g, minlength=self.n_groups) > 1
+            self.chunk_ids[g, c] = cam.chunks["chunk"]
+            np.add.at(self.chunk_counts[:, c], g, cam.counts)
+
+    def match_frames(self):
+        "Build the aligned index table, one row per (chunk group, trigger)."
+        width = max(int(trig.max()) + 1 for trig in self.triggers)
+        keys = [g[cam.chunk_of_frame] * width + trig
+                for cam, g, trig in zip(self.cameras, self.chunk_groups, self.triggers)]
+        self.keys = np.unique(np.concatenate(keys))
+        self.group, self.trigger = np.divmod(self.keys, width)
+
+        shape = (len(self.keys), len(self.cameras))
+        self.frame = np.full(shape, -1, dtype=np.int64)
+        self.offset = np.full(shape, -1, dtype=np.int64)
+        self.time = np.full(shape, np.nan)
+        for c, (cam, k, t) in enumerate(zip(self.cameras, keys, self.times)):
+            rows = np.searchsorted(self.keys, k)
+            self.frame[rows, c] = cam.index
+            self.offset[rows, c] = cam.position
+            self.time[rows, c] = t
+
+    def process(self):
+        "Compute the skew of each camera to the others and its drift in each chunk."
+        present = ~np.isnan(self.time)
+        self.n_cameras = present.sum(axis=1)
+        shared = self.n_cameras >= 2
+        consensus = np.full(len(self.keys), np.nan)
+        if shared.any():
+            consensus[shared] = np.nanmedian(self.time[shared], axis=1)
+        self.consensus = consensus
+        self.skew = self.time - consensus[:, None]
+        with np.errstate(invalid="ignore"):
+            self.spread = np.where(shared, np.nanmax(self.time, axis=1) - np.nanmin(self.time, axis=1), np.nan)
+
+        # Least squares slope of the skew against the trigger index, per chunk group
+        valid = ~np.isnan(self.skew)
+        x = np.where(valid, self.trigger[:, None], 0).astype(np.float64)
+        y = np.where(valid, self.skew, 0)
+        self.drift = np.full((self.n_groups, len(self.cameras)), np.nan)
+        for c in range(len(self.cameras)):
+            n = np.bincount(self.group, valid[:, c], self.n_groups)
+            sx = np.bincount(self.group, x[:, c], self.n_groups)
+            sy = np.bincount(self.group, y[:, c], self.n_groups)
+            sxx = np.bincount(self.group, x[:, c] ** 2, self.n_groups)
+            sxy = np.bincount(self.group, x[:, c] * y[:, c], self.n_groups)
+            first = np.full(self.n_groups, np.inf)
+            last = np.full(self.n_groups, -np.inf)
+            np.minimum.at(first, self.group[valid[:, c]], self.trigger[valid[:, c]])
+            np.maximum.at(last, self.group[valid[:, c]], self.trigger[valid[:, c]])
+            variance = n * sxx - sx ** 2
+            with np.errstate(invalid="ignore", divide="ignore"):
+                slope = np.where((n >= 2) & (variance > 0), (n * sxy - sx * sy) / variance, np.nan)
+            # Change of the skew between the first and the last frame of the chunk
+            self.drift[:, c] = slope * (last - first)
+
+        counts = np.where(self.chunk_ids >= 0, self.chunk_counts, -1)
+        self.mismatched = ((counts != counts[:, :1]).any(axis=1) | (self.duplicates > 0))
+
+    @property
+    def mismatched_chunks(self):
+        "Return the chunk groups where the cameras disagree on the number of frames."
+        return np.flatnonzero(self.mismatched)
+
+    def skew_summary(self, percentiles=SKEW_PERCENTILES):
+        "Return [(camera, *percentiles, max)] of the absolute skew (ms) of each camera, and of the spread."
+        summary = []
+        columns = list(np.abs(self.skew.T)) + [self.spread]
+        for name, values in zip(self.names + ["spread"], columns):
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+            summary.append((name, *(np.percentile(values, percentiles) * 1e3), values.max() * 1e3))
+        return summary
+
+    def table(self):
+        "Return the aligned index table as a structured array."
+        fields = [("chunk", np.int64), ("trigger", np.int64), ("n_cameras", np.int64), ("time", np.float64)]
+        for name in self.names:
+            fields += [(f"{name}_chunk", np.int64), (f"{name}_frame", np.int64),
+                       (f"{name}_offset", np.int64), (f"{name}_time", np.float64)]
+        table = np.zeros(len(self.keys), dtype=fields)
+        table["chunk"] = self.group
+        table["trigger"] = self.trigger
+        table["n_cameras"] = self.n_cameras
+        table["time"] = np.where(np.isnan(self.consensus), np.nanmin(self.time, axis=1), self.consensus)
+        for c, name in enumerate(self.names):
+            table[f"{name}_chunk"] = np.where(self.frame[:, c] >= 0, self.chunk_ids[self.group, c], -1)
+            table[f"{name}_frame"] = self.frame[:, c]
+            table[f"{name}_offset"] = self.offset[:, c]
+            table[f"{name}_time"] = self.time[:, c]
+        return table
+
+    def write(self, path):
+        "Replace ALIGNMENT_FILE in a directory with the aligned index table, return its path."
+        path = Path(path) / ALIGNMENT_FILE
+        if path.exists():
+            path.unlink()
+        table = self.table()
+        records = RecordFile(path, table.dtype)
+        records.append(table)
+        records.close()
+        return path
+
+    def print_report(self):
+        "Print the skew of each camera, then the drift and frame counts of each chunk."
+        print(f"{len(self.names)} cameras - {self.n_groups} chunks - {len(self.keys)} triggers "
+              f"- {len(self.mismatched_chunks)} mismatched chunks ({self.clock} clock)")
+        print(f"    {'skew':<16}{'p50 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}")
+        for name, p50, p99, maximum in self.skew_summary():
+            print(f"    {name:<16}{p50:10.3f}{p99:10.3f}{maximum:10.3f}")
+        print("    chunk  " + "".join(f"{name:>16}" for name in self.names))
+        for g in range(self.n_groups):
+            cells = []
+            for c in range(len(self.names)):
+                if self.chunk_ids[g, c] < 0:
+                    cells.append(f"{'missing':>16}")
+                    continue
+                drift = "" if np.isnan(self.drift[g, c]) else f"{self.drift[g, c] * 1e3:+.2f}ms"
+                cells.append(f"{self.chunk_counts[g, c]:>7} {drift:>8}")
+            flag = "  <- mismatch" if self.mismatched[g] else ""
+            print(f"    {g:>5}  " + "".join(cells) + flag)
+
+
+if __name__ == "__main__":
+    import argparse
+    from tiscam.config import read_config
+    from tiscam.analysis import expected_timing
+
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", "--path",
+                        help="Path to the directory containg the cameras",
+                        dest="path", default="~/data",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-c", "--config",
+                        help="Path to the configuration file, to get the expected period and pause",
+                        dest="config_path", default=None,
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("--cam-prefix",
+                        help="Prefix of directories for each cam (ex. [cam]1, [cam]2)",
+                        dest="prefix", default="cam")
+    parser.add_argument("--clock", help="Clock of the frame times",
+                        dest="clock", default="wall", choices=CLOCKS)
+    parser.add_argument("-t", "--tolerance",
+                        help="Largest difference between the starts of a chunk on two cameras (ms)",
+                        dest="tolerance", default=None, type=float)
+    parser.add_argument("--no-write", help="Only print the report",
+                        dest="write", action="store_false")
+    args = parser.parse_args()
+
+    period, pause = None, 0
+    if args.config_path is not None:
+        period, pause = expected_timing(read_config(args.config_path))
+    tolerance = args.tolerance / 1000 if args.tolerance is not None else None
+
+    alignment = SessionAlignment(load_session(args.path, args.prefix, period=period, pause=pause),
+                                 args.clock, tolerance, pause)
+    alignment.print_report()
+    if args.write:
+        print(f"Aligned index table written to {alignment.write(args.path)}")
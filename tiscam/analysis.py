@@ -0,0 +1,138 @@
+"""
+Vectorized analysis of the frame timestamps of a recording.
+
+All the chunks of a camera are loaded at once from its record files and
+every quantity is computed on the whole session with NumPy, per-chunk
+values being obtained with reduceat over the chunk boundaries.
+"""
+import numpy as np
+from pathlib import Path
+
+from tiscam.timestamps import read_frames, read_chunks, CHUNKS_FILE
+
+
+def expected_timing(config):
+    "Return the expected interframe period and pause between chunks (s) from a config dict."
+    trigger = config["tiscam"]["properties"]["common"]["Trigger Mode"]
+    if trigger:
+        return 1 / config["pwm"]["frequency"], config["pwm"]["chunk_pause"] / 1000
+    return 1 / config["tiscam"]["caps"]["common"]["framerate"], 0
+
+
+class CameraTimestamps:
+    """Timestamps statistics of all the chunks of a camera.
+
+    :param camera_dir: directory containing the record files of the camera
+    :param period: expected interframe period (s), estimated per chunk from
+                   the framerate saved by the recorder if None
+    :param pause: expected pause between two chunks (s)
+    :param ignore_last: whether to ignore the last chunk, which may be incomplete
+    :param chunk_ids: ids of the chunks to load, all of them if None
+    """
+
+    def __init__(self, camera_dir, period=None, pause=0, ignore_last=False, chunk_ids=None):
+        "Load every chunk of the camera and compute the statistics."
+        self.path = Path(camera_dir)
+        self.name = self.path.name
+        self.pause = pause
+        self.load(ignore_last, chunk_ids)
+        self.set_period(period)
+        self.process()
+
+    def load(self, ignore_last, chunk_ids=None):
+        "Load all the frames and chunks, skipping empty chunks."
+        frames = read_frames(self.path)
+        chunks = read_chunks(self.path)
+        chunks = chunks[chunks["n_frames"] > 0]
+        if ignore_last:
+            chunks = chunks[:-1]
+        if chunk_ids is not None:
+            chunks = chunks[np.isin(chunks["chunk"], chunk_ids)]
+        self.chunks = np.asarray(chunks)
+        self.frames = frames[np.isin(frames["chunk"], self.chunks["chunk"])]
+        self.starts = np.searchsorted(self.frames["chunk"], self.chunks["chunk"], side="left")
+        self.counts = np.searchsorted(self.frames["chunk"], self.chunks["chunk"],
+                                      side="right") - self.starts
+        self.chunk_of_frame = np.repeat(np.arange(len(self.chunks)), self.counts)
+        self.wall = self.frames["wall"]
+        self.index = self.frames["frame"]
+        self.loss = self.chunks["loss"]
+
+    def set_period(self, period):
+        "Set the expected period of each chunk and of each frame."
+        if period is None:
+            self.chunk_period = 1 / self.chunks["framerate"]
+        else:
+            self.chunk_period = np.full(len(self.chunks), period)
+        self.period = self.chunk_period[self.chunk_of_frame]
+
+    def process(self):
+        "Compute per-frame and per-chunk statistics."
+        if len(self.chunks) == 0:
+            self.t0 = self.tn = np.zeros(0)
+            self.intervals = self.deviation = self.drift = self.ideal_times = np.zeros(0)
+            self.position = self.trigger = np.zeros(0, dtype=int)
+            return
+        is_first = np.zeros(len(self.wall), dtype=bool)
+        is_first[self.starts] = True
+        self.position = np.arange(len(self.wall)) - np.repeat(self.starts, self.counts)
+
+        self.t0 = np.minimum.reduceat(self.wall, self.starts)
+        self.tn = np.maximum.reduceat(self.wall, self.starts)
+        self.relative_times = self.wall - self.t0[self.chunk_of_frame]
+
+        self.intervals = np.diff(self.wall, prepend=np.nan)
+        self.intervals[is_first] = np.nan
+        self.deviation = np.where(is_first, 0, self.intervals - self.period)
+        cumulative = np.cumsum(self.deviation)
+        self.drift = cumulative - np.repeat(cumulative[self.starts] - self.deviation[self.starts],
+                                            self.counts)
+
+        self.duration = self.tn - self.t0
+        expected_frames = np.where(self.chunks["expected_frames"] > 0,
+                                   self.chunks["expected_frames"], self.counts - 1)
+        self.expected_duration = expected_frames * self.chunk_period
+        self.excess_duration = self.duration - self.expected_duration
+        self.pause_excess = np.concatenate([[np.nan], self.t0[1:] - self.tn[:-1]]) - self.pause
+
+        missing = np.rint(self.intervals / self.period) - 1
+        self.drops = np.flatnonzero(missing > 0)
+        self.dropped_frames = np.where(missing > 0, missing, 0)
+        self.chunk_dropped = np.add.reduceat(self.dropped_frames, self.starts)
+
+        self.trigger = self.trigger_indices()
+        first_trigger = self.trigger[self.starts][self.chunk_of_frame]
+        self.ideal_times = (self.trigger - first_trigger) * self.period
+
+    def trigger_indices(self):
+        """Return the index of the trigger of each frame in its chunk, counting the dropped frames.
+
+        Segmented chunks are indexed by the recorder, otherwise the frames
+        are numbered as received and the drops are estimated from the intervals.
+        """
+        expected = self.chunks["expected_frames"][self.chunk_of_frame]
+        chunk = self.chunks["chunk"][self.chunk_of_frame]
+        dropped = np.cumsum(self.dropped_frames)
+        dropped -= np.repeat(dropped[self.starts] - self.dropped_frames[self.starts], self.counts)
+        estimated = self.position + dropped
+        return np.where(expected > 0, self.index - chunk * expected, estimated).astype(np.int64)
+
+    def chunk_slice(self, i):
+        "Return the slice of the per-frame arrays corresponding to the i-th chunk."
+        return slice(self.starts[i], self.starts[i] + self.counts[i])
+
+    def chunk_names(self):
+        "Return the video names of the chunks."
+        return [f"{first:06d}" for first in self.chunks["first_frame"]]
+
+    @property
+    def total_loss(self):
+        "Return the number of frames lost in the session."
+        return int(self.loss.sum())
+
+
+def load_session(path, prefix="cam", **kwargs):
+    "Return the CameraTimestamps of every camera directory in path that contains records."
+    cameras = sorted(Path(path).glob(f"{prefix}*"))
+    return [CameraTimestamps(c, **kwargs) for c in cameras
+            if (c / CHUNKS_FILE).exists()]
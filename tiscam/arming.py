@@ -0,0 +1,114 @@
+"""
+Armed start of the recorders.
+
+With `armed = true` in [tiscam.start] (or --arm), every camera is prepared
+before the start command: output directory cleaned without prompting,
+configuration checked, device opened, properties applied and pipeline
+prerolled in PAUSED. The start command then only sets the pipelines to
+PLAYING, with the same clock and base time, so their running times are
+comparable. It is SIGUSR2, or a connection sending "start" to `address`
+("host:port" or "unix:/path/to/socket"):
+
+    kill -USR2 <pid>
+    python -m tiscam.arming unix:/tmp/tiscam-start.sock
+
+The time from the start command to the first frame of each camera is
+logged and reported.
+"""
+import os
+import time
+import socket
+import threading
+
+from tiscam.metrics import parse_address
+
+START_COMMAND = "start"
+
+
+class StartListener:
+    """Call a function when a start command is received on a socket.
+
+    :param address: "host:port" or "unix:/path/to/socket"
+    :param callback: function called with the wall time of the command, once
+    """
+
+    def __init__(self, address, callback):
+        "Bind the socket."
+        self.address = parse_address(address)
+        self.callback = callback
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen()
+        self.started = threading.Event()
+        self.thread = None
+
+    def start(self):
+        "Wait for the start command in a daemon thread."
+        self.thread = threading.Thread(target=self.run, name="start-listener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        "Accept connections until a start command is received."
+        while not self.started.is_set():
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return  # Closed by stop
+            with connection:
+                command = connection.recv(64).decode(errors="replace").strip()
+                t = time.time()
+                if command != START_COMMAND:
+                    connection.sendall(f"unknown command {command!r}\n".encode())
+                    continue
+                connection.sendall(b"ok\n")
+            self.started.set()
+            self.callback(t)
+
+    def stop(self):
+        "Close the socket and remove the Unix socket file."
+        self.started.set()
+        self.socket.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def send_start(address, timeout=5):
+    "Send the start command to a recorder and return its reply."
+    address = parse_address(address)
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(address)
+        s.sendall(f"{START_COMMAND}\n".encode())
+        return s.recv(64).decode().strip()
+
+
+def first_frame_report(cameras):
+    "Return the lines reporting the time to the first frame of the cameras {serial: Camera}."
+    delays = {serial: camera.time_to_first_frame for serial, camera in cameras.items()}
+    received = [d for d in delays.values() if d is not None]
+    earliest = min(received) if received else 0
+    lines = [f"{'camera':>12}{'first frame (ms)':>18}{'after earliest (ms)':>21}"]
+    for serial, delay in delays.items():
+        if delay is None:
+            lines.append(f"{serial:>12}{'-':>18}{'-':>21}")
+        else:
+            lines.append(f"{serial:>12}{delay * 1e3:18.1f}{(delay - earliest) * 1e3:21.1f}")
+    if len(received) > 1:
+        lines.append(f"Spread of the first frames: {(max(received) - earliest) * 1e3:.1f}ms")
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("address", help='Start address of the armed recorder, "host:port" or "unix:/path"')
+    args = parser.parse_args()
+    print(send_start(args.address))
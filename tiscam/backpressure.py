@@ -0,0 +1,252 @@
+"""
+Backpressure between the camera and the disk.
+
+A sampler thread reads, at a fixed interval, the fill level of the queue
+before the encoder, the encoder latency (measured with pad probes matching
+the PTS of the buffers entering and leaving the encoder) and the rate at
+which bytes reach the sink writing the chunks. The last sample is kept in
+`metrics` and logged.
+
+When the queue is full, the policy decides what happens:
+
+    block   upstream waits and tcambin drops the frames it cannot push
+    leaky   the oldest queued frames are dropped
+    grow    the queue is enlarged, up to memory_budget MB of frames
+    spill   the chunks are written in a RAM disk (staging_dir) and moved
+            to the output directory in the background once closed, or
+            directly in the output directory while the RAM disk can not
+            hold the next chunk and staging_reserve MB
+"""
+import time
+import shutil
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from tiscam.diskwriter import DiskGuard
+
+POLICIES = ["block", "leaky", "grow", "spill"]
+LEAKY_DOWNSTREAM = 2
+MAX_PENDING = 1000  # PTS waiting for the encoder output, forgotten beyond
+
+
+class Backpressure:
+    """Sample the backpressure metrics of a pipeline and apply the queue policy.
+
+    :param logger: logger of the camera
+    :param name: name of the camera, used for its staging directory
+    :param policy: one of POLICIES
+    :param interval: interval (in s) between two samples
+    :param memory_budget: maximum size (in MB) of the queued frames with the grow policy
+    :param staging_dir: RAM disk directory used by the spill policy
+    :param staging_reserve: space (in MB) left free in the RAM disk by the spill policy
+    """
+
+    def __init__(self, logger, name, policy="block", interval=1, memory_budget=1024,
+                 staging_dir="/dev/shm/tiscam", staging_reserve=256):
+        "Check the policy and create the staging directory."
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy {policy}, available: {', '.join(POLICIES)}")
+        self.logger = logger
+        self.policy = policy
+        self.interval = interval
+        self.memory_budget = memory_budget
+        self.queue = None
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.overruns = 0
+        self.bytes_written = 0
+        self.bytes_total = 0
+        self.frames_encoded = 0
+        self.frames_at_last_sample = 0
+        self.latencies = []
+        self.pending = {}
+        self.budget_reached = False
+        self.time_of_last_sample = time.perf_counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.staged = {}
+        self.moving = 0
+        if policy == "spill":
+            self.staging_dir = Path(staging_dir) / name
+            self.staging_dir.mkdir(parents=True, exist_ok=True)
+            self.staging_guard = DiskGuard(logger, reserve=staging_reserve)
+            self.mover = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-mover")
+
+    def attach(self, queue, encoder=None, writer_pad=None):
+        """Apply the policy to the queue and probe a newly created pipeline.
+
+        :param queue: queue element before the encoder
+        :param encoder: encoder element, its latency is not measured if None
+        :param writer_pad: pad receiving the bytes written to disk
+        """
+        self.queue = queue
+        self.pending = {}
+        if self.policy == "leaky":
+            queue.set_property("leaky", LEAKY_DOWNSTREAM)
+        queue.connect("overrun", self.on_overrun)
+        if encoder is not None:
+            encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_encoder_input)
+            encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_encoder_output)
+        if writer_pad is not None:
+            writer_pad.add_probe(Gst.PadProbeType.BUFFER, self.on_written)
+
+    def on_encoder_input(self, pad, info):
+        "Store the time at which a frame enters the encoder."
+        if len(self.pending) > MAX_PENDING:
+            self.pending.clear()
+        self.pending[info.get_buffer().pts] = time.perf_counter()
+        return Gst.PadProbeReturn.OK
+
+    def on_encoder_output(self, pad, info):
+        "Measure the time spent by a frame in the encoder."
+        t0 = self.pending.pop(info.get_buffer().pts, None)
+        with self.lock:
+            self.frames_encoded += 1
+            if t0 is not None:
+                self.latencies.append(time.perf_counter() - t0)
+        return Gst.PadProbeReturn.OK
+
+    def on_written(self, pad, info):
+        "Count the bytes written by the sink."
+        size = info.get_buffer().get_size()
+        with self.lock:
+            self.bytes_written += size
+            self.bytes_total += size
+        return Gst.PadProbeReturn.OK
+
+    def on_overrun(self, queue):
+        "Apply the policy when the queue is full, called from the streaming thread."
+        with self.lock:
+            self.overruns += 1
+        if self.policy == "grow":
+            self.grow(queue)
+        elif self.policy != "leaky":
+            self.logger.warning("Queue is full")
+
+    def grow(self, queue):
+        "Double the size of the queue, without exceeding the memory budget."
+        size = queue.get_property("max-size-buffers")
+        level = queue.get_property("current-level-buffers")
+        frame_size = queue.get_property("current-level-bytes") / max(level, 1)
+        limit = int(self.memory_budget * 1e6 // frame_size) if frame_size else 2 * size
+        new_size = min(2 * size, limit)
+        if new_size <= size:
+            if not self.budget_reached:
+                self.logger.warning(f"Queue full at {size} buffers, memory budget reached")
+                self.budget_reached = True
+            return
+        queue.set_property("max-size-buffers", new_size)
+        self.logger.warning(f"Queue full, grown from {size} to {new_size} buffers")
+
+    def sample(self):
+        "Read the current metrics, store and return them."
+        now = time.perf_counter()
+        elapsed = now - self.time_of_last_sample
+        self.time_of_last_sample = now
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            written, self.bytes_written = self.bytes_written, 0
+            overruns = self.overruns
+            encoded = self.frames_encoded - self.frames_at_last_sample
+            self.frames_at_last_sample = self.frames_encoded
+
+        metrics = {"overruns": overruns,
+                   "write_rate": written / elapsed / 1e6 if elapsed > 0 else 0,
+                   "encoder_fps": encoded / elapsed if elapsed > 0 else 0}
+        if self.queue is not None:
+            level = self.queue.get_property("current-level-buffers")
+            size = self.queue.get_property("max-size-buffers")
+            metrics.update(queue_buffers=level,
+                           queue_bytes=self.queue.get_property("current-level-bytes"),
+                           queue_size=size,
+                           queue_fill=level / size if size else 0)
+        if latencies:
+            metrics.update(encoder_latency_mean=sum(latencies) / len(latencies),
+                           encoder_latency_max=max(latencies))
+        if self.policy == "spill":
+            metrics.update(staged_files=len(self.staged) + self.moving,
+                           staging_free=shutil.disk_usage(self.staging_dir).free / 1e6)
+        self.metrics = metrics
+        return metrics
+
+    def log(self, metrics):
+        "Log a sample in a single line."
+        message = f"Backpressure: {metrics['write_rate']:.1f}MB/s written, {metrics['overruns']} overruns"
+        if "queue_buffers" in metrics:
+            message += (f", queue {metrics['queue_buffers']}/{metrics['queue_size']}"
+                        f" ({metrics['queue_fill']:.0%})")
+        if "encoder_latency_mean" in metrics:
+            message += (f", encoder {metrics['encoder_latency_mean'] * 1e3:.2f}ms mean"
+                        f" {metrics['encoder_latency_max'] * 1e3:.2f}ms max")
+        if "staged_files" in metrics:
+            message += (f", {metrics['staged_files']} staged files"
+                        f" ({metrics['staging_free']:.0f}MB free)")
+        self.logger.info(message)
+
+    def run(self):
+        "Sample and log the metrics until stop is called."
+        while not self.stopped.wait(self.interval):
+            try:
+                self.log(self.sample())
+            except Exception as error:
+                self.logger.warning(f"Backpressure sampling failed: {error}")
+
+    def start(self):
+        "Start the sampler thread."
+        self.stopped.clear()
+        self.time_of_last_sample = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name=f"{self.logger.name}-backpressure",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "Stop the sampler thread."
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def staging_path(self, path):
+        "Return the path where a chunk is written, in the staging directory with the spill policy."
+        if self.policy != "spill":
+            return path
+        if not self.staging_guard.has_space(self.staging_dir):
+            self.logger.warning(f"Only {self.staging_guard.free / 1e6:.0f}MB free in {self.staging_dir}, "
+                                f"writing {path} directly")
+            return path
+        staged = str(self.staging_dir / Path(path).name)
+        self.staged[staged] = path
+        return staged
+
+    def commit(self, staged):
+        "Move a closed chunk from the staging directory to the output directory in the background."
+        path = self.staged.pop(str(staged), None)
+        if path is None:
+            return
+        self.staging_guard.record_chunk(staged)
+        with self.lock:
+            self.moving += 1
+        self.mover.submit(self.move, str(staged), path)
+
+    def move(self, staged, path):
+        "Move a chunk to the output directory, called from the mover thread."
+        t0 = time.perf_counter()
+        try:
+            shutil.move(staged, path)
+            self.logger.debug(f"Moved {staged} to {path} in {time.perf_counter() - t0:.2f}s")
+        except Exception as error:
+            self.logger.error(f"Could not move {staged} to {path}: {error}")
+        finally:
+            with self.lock:
+                self.moving -= 1
+
+    def flush(self):
+        "Move every chunk still in the staging directory, once the pipeline is stopped."
+        for staged in list(self.staged):
+            self.commit(staged)
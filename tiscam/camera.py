@@ -9,13 +9,28 @@ Adapted from Romain FAYAT's and Romain SALA's code
 import gi
 import sys
 import time
-import pickle
+import json
+import threading
 from pathlib import Path
+from collections import OrderedDict
 
 gi.require_version("Gst", "1.0")
-gi.require_version("Tcam", "0.1")
+gi.require_version("GstVideo", "1.0")
 
-from gi.repository import GObject, Gst, Tcam
+from gi.repository import Gst, GstVideo
+
+from tiscam.timestamps import TimestampBuffer, TimestampWriter
+from tiscam.encoders import encoder_stage, is_passthrough, BAYER_ENCODERS, CAPS_FILE
+from tiscam.rawwriter import RawChunkWriter, BYTES_PER_PIXEL, DEFAULT_CAPACITY, PENDING_FRAMES
+from tiscam.backpressure import Backpressure
+from tiscam.metrics import Histogram, HANDOFF_BUCKETS
+from tiscam.tracing import Tracer
+from tiscam.sources import create_source
+from tiscam.segmentation import ChunkSegmenter
+from tiscam.tap import FrameTap
+from tiscam.preview import Preview, TEE_NAME
+from tiscam.diskwriter import DiskGuard, ELEMENT_NAME, register
+from tiscam.scheduling import Scheduler
 
 
 class TIS:
@@ -25,49 +40,111 @@ class TIS:
         self.gst_debug_level = gst_debug_level
         self.compression_level = 0
         self.max_buffers_queue = 1
+        self.persistent = False
+        self.source_type = "tcambin"
+        self.backend = None
+        self.encoder_name = "x264"
+        self.encoder_options = {}
+        self.capture_format = "bgrx"
+        self.writer = "mux"
+        self.raw_writer = None
+        self.raw_lock = threading.Lock()
+        self.raw_chunk = None
+        self.raw_pending = OrderedDict()
+        self.written = threading.Condition()
+        self.written_pts = None
+        self.pending_lock = threading.Lock()
+        self.backpressure = None
+        self.tracer = None
+        self.tap = None
+        self.preview = None
+        self.disk = None
+        self.scheduler = None
+        self.clock = None
+        self.base_time = None
+        self.armed = False
+        self.start_time = None
+        self.has_tcam_meta = True
         self.logger = None
-        Gst.init(["record.py", f"--gst-debug-level={self.gst_debug_level}"])
+        self.queue = None
+        self.error = None
+        if not Gst.is_initialized():
+            Gst.init(["record.py", f"--gst-debug-level={self.gst_debug_level}"])
 
     def create_pipeline(self):
         "Creates a Gstreamer pipeline"
-        p = "tcambin name=source ! identity name=id"
+        p = self.backend.description()
+        p += " ! identity name=id"
         # WARNING: Do not change position of identity plugin
 
+        passthrough = self.records_camera_stream
+        # The frame tap and the preview branch off after the first capsfilter
+        tee = ""
+        if self.tap is not None or self.preview is not None:
+            tee = f" ! tee name={TEE_NAME} allow-not-linked=true"
         if self.config.caps["color"]:
-            p += " ! capsfilter name=bayercaps"
-            p += " ! bayer2rgb ! videoconvert"
+            p += " ! capsfilter name=bayercaps" + tee
+            tee = ""
+            if passthrough:
+                # Same bytes as the Bayer frames, in a format accepted by the muxer
+                p += " ! capssetter join=false caps=video/x-raw,format=GRAY8"
+            else:
+                p += " ! bayer2rgb ! videoconvert"
 
-        p += " ! capsfilter name=rawcaps ! videoconvert"
+        if not (passthrough and self.config.caps["color"]):
+            p += " ! capsfilter name=rawcaps" + tee + " ! videoconvert"
 
         if self.livedisplay:
             p += " ! videoscale method=0 add-borders=false"
             p += " ! video/x-raw,width=640,height=360"
             p += " ! fpsdisplaysink sink=ximagesink"
+        elif self.writer == "mmap":
+            # Frames are copied as is in memory-mapped chunk files by on_raw_sample
+            p += " ! queue name=queue"
+            p += " ! appsink name=rawsink emit-signals=true sync=false"
         else:
             p += " ! queue name=queue"
-            p += f" ! x264enc quantizer={self.compression_level} qp-min={self.compression_level} qp-max={self.compression_level} qp-step={self.compression_level} speed-preset=ultrafast tune=zerolatency pass=qual sliced-threads=true"
-            p += " ! matroskamux"
-            p += " ! filesink name=fsink"
+            p += " ! " + encoder_stage(self.encoder_name, self.encoder_options, self.compression_level)
+            if self.persistent:
+                # The muxer is set in init_pipeline, files are named by on_format_location
+                p += " ! splitmuxsink name=fsink async-finalize=false"
+            else:
+                p += " ! matroskamux"
+                p += f" ! {ELEMENT_NAME if self.disk is not None else 'filesink'} name=fsink"
+
+        if self.tap is not None:
+            p += " " + self.tap.description()
 
         self.logger.debug(f"Gst pipeline: {p}")
         self.pipeline = Gst.parse_launch(p)
+        self.clock = None
+        self.base_time = None
 
     def init_pipeline(self, video_path):
         "Initializes the Gstreamer pipeline"
         self.source = self.pipeline.get_by_name("source")
-        self.source.set_property("serial", self.config.caps["serial"])
-        self.logger.debug(f"Serial: {self.config.caps['serial']}")
+        self.backend.attach(self.source, self.get_source_caps())
         self.logger.debug(self.config.config)
 
         self.identity = self.pipeline.get_by_name("id")
         self.identity.connect("handoff", self.on_new_buffer)
 
-        if self.config.caps["color"] == "true":
+        bus = self.pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect("sync-message::error", self.on_error)
+        bus.connect("sync-message::warning", self.on_warning)
+
+        if self.config.caps["color"]:
             self.bayerfilter = self.pipeline.get_by_name("bayercaps")
             self.bayerfilter.set_property("caps", self.get_caps(bayer=True))
 
+            if self.records_camera_stream:
+                self.bayerfilter.get_static_pad("src").connect("notify::caps", self.on_bayer_caps)
+
         self.rawfilter = self.pipeline.get_by_name("rawcaps")
-        self.rawfilter.set_property("caps", self.get_caps(bayer=False))
+        if self.rawfilter is not None:
+            raw_format = "GRAY8" if self.records_camera_stream else "BGRx"
+            self.rawfilter.set_property("caps", self.get_caps(bayer=False, raw_format=raw_format))
 
         if not self.livedisplay:
             try:
@@ -75,47 +152,309 @@ class TIS:
                 self._queue.set_property("max-size-buffers", self.max_buffers_queue)
                 self._queue.set_property("max-size-bytes", 0)
                 self._queue.set_property("max-size-time", 0)
-                self._queue.connect("overrun", self.on_full_queue)
 
             except Exception as e:
                 self.logger.warning(f"No queue was found: {e}")
-            
-            self.filesink = self.pipeline.get_by_name("fsink")
-            self.filesink.set_property("location", video_path)
 
+            self.encoder = self.pipeline.get_by_name("encoder")
             self.filesink = self.pipeline.get_by_name("fsink")
-            self.filesink.set_property("location", video_path)
+            if self.writer == "mmap":
+                rawsink = self.pipeline.get_by_name("rawsink")
+                rawsink.connect("new-sample", self.on_raw_sample)
+                writer_pad = rawsink.get_static_pad("sink")
+            elif self.persistent:
+                self.filesink.set_property("muxer", Gst.ElementFactory.make("matroskamux"))
+                # The sink is set here to probe the bytes it writes
+                sink = self.create_disk_sink() if self.disk is not None else Gst.ElementFactory.make("filesink")
+                self.filesink.set_property("sink", sink)
+                writer_pad = sink.get_static_pad("sink")
+                self.filesink.sinkpads[0].add_probe(Gst.PadProbeType.BUFFER, self.on_written_buffer)
+                self.filesink.connect("format-location", self.on_format_location)
+                bus.connect("sync-message::element", self.on_fragment_message)
+            else:
+                if self.disk is not None:
+                    self.create_disk_sink(self.filesink)
+                self.filesink.set_property("location", self.staging_path(video_path))
+                writer_pad = self.filesink.get_static_pad("sink")
+
+            if self.backpressure is not None:
+                self.backpressure.attach(self._queue, self.encoder, writer_pad)
+            else:
+                self._queue.connect("overrun", self.on_full_queue)
+
+        if self.tracer is not None:
+            self.tracer.attach(self.pipeline)
+        if self.scheduler is not None:
+            self.scheduler.attach(self.pipeline, self.source,
+                                  [self.pipeline.get_by_name("queue"), self.pipeline.get_by_name("fsink")])
+        if self.tap is not None:
+            self.tap.attach(self.pipeline)
+        if self.preview is not None:
+            self.preview.set_pipeline(self.pipeline, bayer=self.config.caps["color"])
+
+    @property
+    def records_camera_stream(self):
+        "Return True if frames are recorded without debayering or conversion"
+        if self.livedisplay:
+            return False
+        if self.writer == "mmap":
+            return self.capture_format == "bayer"
+        if self.capture_format == "bayer":
+            if self.encoder_name not in BAYER_ENCODERS:
+                raise ValueError(f"Bayer capture requires one of the encoders {BAYER_ENCODERS}")
+            return True
+        return is_passthrough(self.encoder_name)
+
+    def on_bayer_caps(self, pad, *args):
+        "Save the negotiated Bayer caps next to the videos, needed to debayer them offline"
+        caps = pad.get_current_caps()
+        if caps is None:
+            return
+        structure = caps.get_structure(0)
+        metadata = {"caps": caps.to_string(),
+                    "format": structure.get_string("format"),
+                    "width": structure.get_value("width"),
+                    "height": structure.get_value("height"),
+                    "stored_as": "GRAY8",
+                    "encoder": self.encoder_name}
+        with open(self.path_to_output / CAPS_FILE, "w") as f:
+            json.dump(metadata, f, indent=4)
+        self.logger.info(f"Recording Bayer frames: {metadata['caps']}")
+
+    def on_raw_sample(self, appsink):
+        "Copy a frame in the memory-mapped file of its chunk, opened on its first frame"
+        sample = appsink.emit("pull-sample")
+        buffer = sample.get_buffer()
+        frame_count, camera_time = self.get_tcam_statistics(buffer)
+        ok, info = buffer.map(Gst.MapFlags.READ)
+        if not ok:
+            self.logger.error("Could not map the buffer")
+            return Gst.FlowReturn.ERROR
+        with self.pending_lock:
+            frame, handoff, chunk = self.raw_pending.pop(buffer.pts, (-1, time.time(), None))
+        try:
+            with self.raw_lock:
+                if chunk is None:
+                    chunk = self.raw_chunk if self.raw_writer is not None else self.queue.chunk
+                if self.raw_writer is not None and chunk != self.raw_chunk:
+                    # First frame of the next chunk, the previous one has no frame left in the queue
+                    self.raw_writer.close()
+                    self.commit_chunk(self.raw_writer.path)
+                    self.raw_writer = None
+                if self.raw_writer is None:
+                    self.open_raw_writer(sample.get_caps(), buffer.get_size(), self.queue.videos[chunk])
+                    self.raw_chunk = chunk
+                self.raw_writer.write(info.data, frame, handoff, buffer.pts, camera_time, frame_count)
+        finally:
+            buffer.unmap(info)
+        return Gst.FlowReturn.OK
+
+    def register_raw_frame(self, pts, frame, handoff, chunk):
+        "Store the index, handoff time and chunk of a frame, written with it by on_raw_sample"
+        with self.pending_lock:
+            self.raw_pending[pts] = (frame, handoff, chunk)
+            if len(self.raw_pending) > PENDING_FRAMES:
+                self.raw_pending.popitem(last=False)
+
+    def open_raw_writer(self, caps, frame_size, video_name):
+        "Preallocate the chunk file of a video for the expected number of frames"
+        structure = caps.get_structure(0)
+        fmt = structure.get_string("format")
+        metadata = {"caps": caps.to_string(),
+                    "format": fmt,
+                    "width": structure.get_value("width"),
+                    "height": structure.get_value("height"),
+                    "bpp": BYTES_PER_PIXEL.get(fmt, 1)}
+        capacity = self.queue.expected_frames or DEFAULT_CAPACITY
+        path = self.staging_path(video_name)
+        self.raw_writer = RawChunkWriter(path, capacity, frame_size, metadata)
+        self.logger.debug(f"Opened {video_name} for {capacity} frames of {frame_size}B")
+
+    def close_raw_writer(self):
+        "Flush and close the chunk file being written, if any"
+        with self.raw_lock:
+            if self.raw_writer is not None:
+                self.raw_writer.close()
+                self.commit_chunk(self.raw_writer.path)
+                self.raw_writer = None
+
+    def create_disk_sink(self, sink=None):
+        "Configure a tiscamsink, created if None, to write with the disk guard of the camera"
+        if sink is None:
+            sink = Gst.ElementFactory.make(ELEMENT_NAME)
+        sink.guard = self.disk
+        sink.set_property("write-size", self.disk.write_size)
+        return sink
+
+    def staging_path(self, path):
+        "Return the path where a chunk is written, which differs from its final path when spilling"
+        if self.backpressure is None:
+            return path
+        return self.backpressure.staging_path(path)
+
+    def commit_chunk(self, path):
+        "Move a closed chunk written in the staging directory to the output directory"
+        if self.disk is not None and self.writer == "mmap":
+            self.disk.record_chunk(path)
+        if self.backpressure is not None:
+            self.backpressure.commit(path)
+
+    def on_format_location(self, splitmux, fragment_id):
+        "Return the path of the next chunk, called by splitmuxsink when opening a file"
+        self.logger.debug(f"Opening fragment {fragment_id}: {self.queue.video_name}")
+        return self.staging_path(self.queue.video_name)
+
+    def on_fragment_message(self, bus, message):
+        "Measure the time splitmuxsink needs to switch from a file to the next"
+        structure = message.get_structure()
+        name = structure.get_name()
+        if name == "splitmuxsink-fragment-closed":
+            self.time_of_fragment_closed = time.perf_counter()
+            self.commit_chunk(structure.get_string("location"))
+        elif name == "splitmuxsink-fragment-opened" and self.time_of_fragment_closed:
+            switch = time.perf_counter() - self.time_of_fragment_closed
+            self.logger.info(f"File switched in {switch * 1e3:.2f}ms")
+            self.time_of_fragment_closed = None
+
+    def on_written_buffer(self, pad, info):
+        "Store the PTS of the last frame received by splitmuxsink, waited for by rotate"
+        with self.written:
+            self.written_pts = info.get_buffer().pts
+            self.written.notify_all()
+        return Gst.PadProbeReturn.OK
+
+    def wait_written(self, pts, timeout):
+        "Wait until the frame of a PTS reached splitmuxsink, False after timeout (in s)"
+        if pts is None or pts == Gst.CLOCK_TIME_NONE:
+            return True
+        with self.written:
+            return self.written.wait_for(
+                lambda: self.written_pts is not None and self.written_pts >= pts, timeout)
+
+    def request_key_frame(self):
+        "Ask the encoder to start the next chunk with a key frame"
+        event = GstVideo.video_event_new_upstream_force_key_unit(
+            Gst.CLOCK_TIME_NONE, True, 0)
+        self.encoder.get_static_pad("src").send_event(event)
+
+    def on_error(self, bus, message):
+        "Log errors posted by the pipeline and let the camera stop itself"
+        error, debug = message.parse_error()
+        self.logger.error(f"Pipeline error from {message.src.get_name()}: {error.message}")
+        self.logger.debug(debug)
+        self.error = error
+        if self.queue is not None:
+            self.queue.stop()
+
+    def on_warning(self, bus, message):
+        "Log warnings posted by the pipeline"
+        warning, debug = message.parse_warning()
+        self.logger.warning(f"Pipeline warning from {message.src.get_name()}: {warning.message}")
+        self.logger.debug(debug)
+
+    def get_queue_level(self):
+        "Return the number of buffers waiting in the queue, None without queue"
+        try:
+            return self._queue.get_property("current-level-buffers")
+        except Exception:
+            return None
 
     def on_full_queue(self, *args):
         self.logger.warning("Queue is full")
         return False
 
-    def stop_pipeline(self):
-        "Stops the pipeline"
+    def preroll(self, timeout=5):
+        "Bring the pipeline to PAUSED, opening the device, without starting the frames"
+        self.pipeline.set_state(Gst.State.PAUSED)
+        result, _, _ = self.pipeline.get_state(int(timeout * Gst.SECOND))
+        if result == Gst.StateChangeReturn.FAILURE:
+            raise RuntimeError("The pipeline could not be prerolled")
+        if result == Gst.StateChangeReturn.ASYNC:
+            self.logger.warning(f"The pipeline did not preroll within {timeout}s")
+
+    def play(self, base_time=None):
+        "Start the pipeline, with a base time shared by several pipelines if given, then the frames of the synthetic sources"
+        if base_time is not None:
+            self.pipeline.use_clock(Gst.SystemClock.obtain())
+            self.pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+            self.pipeline.set_base_time(base_time)
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self.backend.start()
+        if self.tap is not None:
+            self.tap.start()
+
+    def stop_pipeline(self, eos_timeout=2):
+        "Stops the pipeline once the frames in flight reached the file, which the EOS finalizes"
+        self.backend.stop()
+        if self.tap is not None:
+            self.tap.stop()
+        if self.preview is not None:
+            self.preview.stop_monitor()
+        self.pipeline.send_event(Gst.Event.new_eos())
+        message = self.pipeline.get_bus().timed_pop_filtered(
+            eos_timeout * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message is None:
+            self.logger.warning(f"The pipeline did not drain within {eos_timeout}s, the last frames may be lost")
         self.pipeline.set_state(Gst.State.NULL)
+        self.close_raw_writer()
+        if self.backpressure is not None:
+            self.backpressure.flush()
 
     def set_image_callback(self, function, *data):
         "Sets the specific function called when a frame is received"
         self.image_callback = function
         self.image_callback_data = data
 
-    def on_new_buffer(self, *args):
+    def on_new_buffer(self, identity, buffer):
         "Set the generic ffunction called when a frame is received"
+        self.image_callback(self, buffer, *self.image_callback_data);
+        return False
+
+    def get_running_time(self):
+        "Return the running time of the pipeline (ns), -1 before it started"
+        if self.clock is None:
+            self.clock = self.pipeline.get_clock()
+            if self.clock is None:
+                return -1
+            self.base_time = self.pipeline.get_base_time()
+        return self.clock.get_time() - self.base_time
+
+    def get_tcam_statistics(self, buffer):
+        "Return (frame_count, camera_time_ns) from the tcam buffer metadata, -1 when missing"
+        if not self.has_tcam_meta:
+            return -1, -1
         try:
-            self.logger.debug(f"Buffers in queue: {self._queue.get_property('current-level-buffers')}")
+            stats = buffer.get_meta("TcamStatisticsMetaApi").get_statistics()
+            return stats.get_value("frame_count"), stats.get_value("camera_time_ns")
         except Exception:
-            pass
-
-        self.image_callback(self, *self.image_callback_data);
-        return False
+            self.logger.info("No tcam statistics in buffers, hardware timestamps disabled")
+            self.has_tcam_meta = False
+            return -1, -1
+
+    def sample_clocks(self):
+        "Read the wall clock and the pipeline clock at the same time"
+        if self.pipeline is None or self.pipeline.get_clock() is None:
+            return {}
+        clock = self.pipeline.get_clock()
+        return {"wall": time.time(),
+                "clock_time": clock.get_time(),
+                "base_time": self.pipeline.get_base_time()}
+
+    def get_source_caps(self):
+        "Return the caps of the frames produced by the camera, emulated by the synthetic sources"
+        if self.config.caps["color"]:
+            return self.get_caps(bayer=True)
+        return self.get_caps(raw_format="GRAY8" if self.records_camera_stream else "BGRx")
 
-    def get_caps(self, bayer=False):
+    def get_caps(self, bayer=False, raw_format="BGRx"):
         "Get pixel and sink format and frame rate"
         self.logger.debug("Creating caps")
         if bayer:
             fmt = "video/x-bayer,format=rggb,"
         else:
-            fmt = "video/x-raw,format=BGRx,"
+            fmt = f"video/x-raw,format={raw_format},"
 
         fmt += f"width={self.config.caps['width']},"
         fmt += f"height={self.config.caps['height']},"
@@ -130,28 +469,8 @@ class TIS:
         return caps
 
     def set_property(self, property_name, value):
-        "Set properties, trying to convert the values to the appropriate types"
-        self.logger.debug(f"Setting property {property_name} at {value}")
-        try:
-            prop = self.source.get_tcam_property(property_name)
-            if prop.type == 'double':
-                value = float(value)
-            if prop.type == 'integer':
-                value = int(value)
-            if prop.type == 'boolean':
-                if (value == "True") or (value == "true") or (value is True):
-                    value = True
-                elif (value == "False") or (value == "false") or (value is False):
-                    value = False
-                else:
-                    raise
-
-            result = self.source.set_tcam_property(property_name, GObject.Value(type(value),value))
-            if result is False:
-                self.logger.warning("Failed to set {} to value {}. value type is {} prop type is {}, range is {}-{}".format(property_name, value, type(value), prop.type, prop.min, prop.max))
-        except Exception as error:
-            self.logger.error("Error set Property {0}: {1}", property_name, format(error))
-            raise
+        "Set a camera property through the source backend"
+        self.backend.set_property(property_name, value)
 
 
 class Camera(TIS):
@@ -161,7 +480,7 @@ class Camera(TIS):
     :param path_to_output: directory where videos and logs should be saved
     """
 
-    def __init__(self, config, logger, path_to_output='videos', gst_debug_level=1, compression_level=0, max_buffers_queue=1):
+    def __init__(self, config, logger, path_to_output='videos', gst_debug_level=1, compression_level=0, max_buffers_queue=1, persistent=False, source_type="tcambin", log_interval=1, encoder_name="x264", encoder_options=None, capture_format="bgrx", writer="mux", backpressure=None, tracing=False, tap=None, preview=None, disk=None, scheduling=None):
         "Initialize the Camera object."
         super().__init__(gst_debug_level)
         self.path_to_output = Path(path_to_output)
@@ -172,10 +491,41 @@ class Camera(TIS):
         self.livedisplay = False
         self.compression_level = compression_level
         self.max_buffers_queue = max_buffers_queue
+        self.persistent = persistent
+        self.source_type = source_type
+        self.backend = create_source(source_type, config, logger)
+        self.log_interval = log_interval
+        self.encoder_name = encoder_name
+        self.encoder_options = encoder_options or {}
+        self.capture_format = capture_format
+        self.writer = writer
+        if backpressure:
+            self.backpressure = Backpressure(logger, self.path_to_output.name, **backpressure)
+        self.tracer = Tracer(self.path_to_output) if tracing else None
+        tap = dict(tap or {})
+        if tap.pop("enabled", False):
+            self.tap = FrameTap(logger, **tap)
+        preview = dict(preview or {})
+        if preview.pop("enabled", False):
+            self.preview = Preview(logger, self.path_to_output.name, **preview)
+        disk = dict(disk or {})
+        if disk.pop("enabled", False):
+            self.disk = DiskGuard(logger, **disk)
+            register()
+        scheduling = dict(scheduling or {})
+        if scheduling.pop("enabled", False):
+            self.scheduler = Scheduler(logger, **scheduling)
+            if self.scheduler.encoder_threads:
+                self.encoder_options = {**self.encoder_options, "threads": self.scheduler.encoder_threads}
+        self.rotation_times = []
+        self.time_of_fragment_closed = None
+        self.running = False
+        self.thread = None
 
     def capture(self):
         "Start capturing videos and handle keyboardinterrupt."
         self.create_callback()
+        self.running = True
         try:
             self.loop()
         except KeyboardInterrupt:
@@ -183,68 +533,285 @@ class Camera(TIS):
         finally:
             self.stop_capture()
 
+    def arm(self, preroll_timeout=5):
+        "Build the first pipeline, apply the properties and preroll it, so start only has to play it."
+        self.create_callback()
+        if not self.prepare_chunk():
+            raise RuntimeError("Not enough disk space for the first chunk")
+        self.preroll(preroll_timeout)
+        self.armed = True
+        self.logger.info("Armed")
+
+    def disarm(self):
+        "Release the pipeline of a camera armed, or failing to arm, and not started."
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+        self.close_raw_writer()
+        self.armed = False
+        self.running = False
+
     def start_capture(self):
         "Start capturing videos."
         self.logger.info("Starting to record")
-        self.create_callback()
+        if self.armed:
+            self.play()
+        else:
+            self.create_callback()
+        self.running = True
         self.loop()
+        # The loop only returns by itself when the disk is full
+        self.stop_capture()
+
+    def start(self, base_time=None):
+        "Start capturing videos in a background thread, an armed pipeline being played at once with base_time."
+        self.logger.info("Starting to record")
+        if self.armed:
+            self.play(base_time)
+        else:
+            self.create_callback()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.logger.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        "Run the capture loop until stop is called, without raising errors."
+        try:
+            self.loop()
+        except Exception as error:
+            self.logger.exception(f"Capture failed: {error}")
+            self.error = error
+        finally:
+            self.running = False
+            if self.pipeline is not None:
+                self.stop_capture()
+
+    def stop(self, wait=True):
+        "Ask the capture loop to stop and wait for the last video to be closed."
+        self.running = False
+        if self.queue is not None:
+            self.queue.stop()
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def toggle_preview(self):
+        "Attach the preview if it is detached, detach it otherwise."
+        if self.preview is None:
+            self.logger.warning("The preview is not enabled in [tiscam.preview]")
+            return
+        self.preview.toggle()
+
+    @property
+    def time_to_first_frame(self):
+        "Return the time (in s) from the start of the pipeline to its first frame, None before it."
+        if self.start_time is None or self.queue is None or self.queue.first_frame_time is None:
+            return None
+        return self.queue.first_frame_time - self.start_time
+
+    def log_first_frame(self):
+        "Log the time to the first frame."
+        self.logger.info(f"First frame {self.time_to_first_frame * 1e3:.1f}ms after the start")
+
+    @property
+    def is_alive(self):
+        "Return True while the background capture is running."
+        return self.thread is not None and self.thread.is_alive()
 
     def stop_capture(self):
-        "Stop the capture and cleanup."
+        "Stop the capture and cleanup, the timestamps being saved once the pipeline is drained."
         self.logger.info("Killing pipeline")
-        self.queue.close()
+        self.queue.clocks = self.sample_clocks()
         self.stop_pipeline()
+        self.queue.close()
+        self.dump_trace()
+        if self.tracer is not None:
+            self.tracer.close()
 
 
     def loop(self):
+        "Record videos until stopped, sampling the backpressure metrics meanwhile."
+        if self.backpressure is not None:
+            self.backpressure.start()
+        try:
+            if self.persistent:
+                self.loop_persistent()
+            else:
+                self.loop_chunks()
+        finally:
+            if self.backpressure is not None:
+                self.backpressure.stop()
+
+    def loop_chunks(self):
         "Manage creation and realease of videos."
         self.queue.livedisplay = False
-        while True:
-            self.queue.new_video()
-            self.logger.info(f"New video: {self.queue.video_name}")
-
-            self.create_pipeline()
-            self.init_pipeline(video_path=self.queue.video_name)
-            self.apply_properties()
-            self.logger.info("Created new pipeline")
-
-            self.pipeline.set_state(Gst.State.PLAYING)
+        rotation_start = None
+        while self.running:
+            if not self.begin_chunk():
+                return
             self.logger.info("Started pipeline")
+            if rotation_start is not None:
+                self.log_rotation(rotation_start)
 
             self.queue.time_of_last_frame = time.time()
             self.queue.check_delay()
             self.queue.go = True
 
+            rotation_start = time.perf_counter()
+            self.check_error()
             self.stop_capture()
 
+    def loop_persistent(self):
+        "Build the pipeline once and rotate the output file at each trigger gap."
+        self.queue.livedisplay = False
+        if not self.begin_chunk():
+            return
+        self.logger.info("Started pipeline")
+
+        while True:
+            self.queue.time_of_last_frame = time.time()
+            self.queue.check_delay()
+            self.queue.go = True
+            self.check_error()
+            if not self.running or not self.check_disk():
+                return
+            self.rotate()
+
+    def begin_chunk(self):
+        "Build and play the pipeline of the next chunk, already playing if the camera was armed, False if the disk is full."
+        if self.armed:
+            self.armed = False
+            return True
+        if not self.prepare_chunk():
+            return False
+        self.play()
+        return True
+
+    def prepare_chunk(self):
+        "Name the next video and build, configure its pipeline, False if the disk can not hold it."
+        if not self.check_disk():
+            return False
+        self.new_video()
+        self.logger.info(f"New video: {self.queue.video_name}")
+
+        self.create_pipeline()
+        self.init_pipeline(video_path=self.queue.video_name)
+        self.apply_properties()
+        self.logger.info("Created persistent pipeline" if self.persistent else "Created new pipeline")
+        return True
+
+    def check_disk(self):
+        "Return False if no disk holds the next chunk, stopping the camera, its directory being switched with the switch policy"
+        if self.disk is None:
+            return True
+        directory = self.disk.next_directory(self.queue.video_dir)
+        if directory is None:
+            self.logger.error("Not enough disk space for the next chunk, stopping the camera")
+            self.running = False
+            return False
+        self.queue.video_dir = directory
+        return True
+
+    def check_error(self):
+        "Raise the error posted by the pipeline, if any."
+        if self.error is not None:
+            raise RuntimeError(f"Pipeline error: {self.error.message}")
+
+    def rotate(self):
+        "Close the current chunk and start the next file without stopping the pipeline."
+        rotation_start = time.perf_counter()
+        last_pts = self.queue.last_pts
+        self.queue.clocks = self.sample_clocks()
+        if self.writer == "mmap":
+            # on_raw_sample switches to the next file with its first frame, named before it is looked up
+            with self.raw_lock:
+                self.queue.close()
+                self.new_video()
+        else:
+            self.queue.close()
+            # The frames of the chunk still in the queue or the encoder belong to the current file
+            if not self.wait_written(last_pts, self.queue.timeout_delay):
+                self.logger.warning("The last frame of the chunk did not reach the file in time, "
+                                    "the next file may start with it")
+            self.new_video()
+            self.request_key_frame()
+            self.filesink.emit("split-now")
+        self.logger.info(f"New video: {self.queue.video_name}")
+        self.log_rotation(rotation_start)
+        self.dump_trace()
+
+    def new_video(self):
+        "Name the next video and tag the next traced buffers with its chunk."
+        self.queue.new_video()
+        if self.tracer is not None:
+            self.tracer.chunk_id = len(self.queue.videos) - 1
+
+    def dump_trace(self):
+        "Write the stage latencies of the buffers traced since the last dump."
+        if self.tracer is None:
+            return
+        lost = self.tracer.lost
+        n_buffers = self.tracer.dump()
+        self.logger.debug(f"Traced {n_buffers} buffers")
+        if self.tracer.lost > lost:
+            self.logger.warning(f"{self.tracer.lost - lost} traced buffers were lost, "
+                                "dropped by an element or overwritten before the dump")
+
+    def log_rotation(self, rotation_start):
+        "Store and log the time spent between the end of a chunk and the next one."
+        rotation_time = time.perf_counter() - rotation_start
+        self.rotation_times.append(rotation_time)
+        self.logger.info(f"Chunk rotation took {rotation_time * 1e3:.2f}ms")
+
     def create_callback(self):
         "Define function to call when a frame is received."
         self.queue = Queue(self.path_to_output,
                            self.config.pwm['chunk_pause'],
                            self.config.pwm['chunk_size'],
-                           self.config.properties['Trigger Mode'],
-                           self.logger)
+                           self.config.trigger_mode,
+                           self.logger,
+                           self.log_interval,
+                           extension="raw" if self.writer == "mmap" else "avi",
+                           frequency=self.config.pwm['frequency'])
         self.set_image_callback(add_frame, self.queue)
 
     def apply_properties(self):
-        "Apply properties to camera."
-        for k, v in self.config.properties.items():
-            self.set_property(k, v)
+        "Apply the property plan to the camera, setting only the values that changed."
+        changed = self.config.plan.apply(self.backend)
+        self.logger.debug(f"Applied {len(changed)} properties: {', '.join(changed)}")
+
 
+def add_frame(tis, buffer, queue):
+    """Write a timestamp and increases the counter.
 
-def add_frame(tis, queue):
-    "Write a timestamp and increases the counter."
-    if queue.busy:
-        queue.logger.error("[!] Frame dropped!")
-        return
-    queue.busy = True
+    Along with the wall clock, the buffer PTS/DTS, the pipeline running time
+    and the tcam frame count and device timestamp are stored when available.
+    """
     t = time.time()
-    queue.timestamps[queue.counter] = t
+    if buffer is None:
+        queue.timestamps.append(queue.next_frame(t), t)
+    else:
+        frame_count, camera_time = tis.get_tcam_statistics(buffer)
+        running_time = tis.get_running_time()
+        frame = queue.next_frame(t, frame_count)
+        queue.timestamps.append(frame, t, buffer.pts, buffer.dts,
+                                running_time, camera_time, frame_count)
+        if tis.tap is not None:
+            tis.tap.register(buffer.pts, frame, t)
+        if tis.writer == "mmap":
+            tis.register_raw_frame(buffer.pts, frame, t, queue.chunk)
+        queue.last_pts = buffer.pts
+        if running_time >= 0 and buffer.pts != Gst.CLOCK_TIME_NONE:
+            queue.handoff_latency.observe((running_time - buffer.pts) / 1e9)
     queue.time_of_last_frame = t
-    queue.counter += 1
+    if queue.first_frame_time is None:
+        queue.first_frame_time = t
+        if tis is not None and tis.start_time is not None:
+            tis.log_first_frame()
+    queue.received += 1
     queue.chunk_counter += 1
-    queue.logger.info(f"Adding frame {queue.counter} to the queue")
-    queue.busy = False
+    if t - queue.time_of_last_summary >= queue.log_interval:
+        queue.log_summary(t, tis)
+    if queue.chunk_counter == 1 or queue.chunk_complete:
+        queue.notify_frame()
 
 
 class Queue:
@@ -253,32 +820,60 @@ class Queue:
     : param path_to_output: Directory where videos and logs should be saved
     : param timeout_delay: The timeout (in s) for starting an new video
     : param expected_frames: The expected number of frame for each video
+    : param log_interval: Interval (in s) between two summaries of received frames
+    : param extension: Extension of the video files, raw for the memory-mapped writer
+    : param frequency: The trigger frequency (in Hz), used to segment the chunks
 
     """
 
-    def __init__(self, path_to_output, chunk_pause, expected_frames, trigger_mode, logger):
+    def __init__(self, path_to_output, chunk_pause, expected_frames, trigger_mode, logger, log_interval=1, extension="avi",
+                 frequency=None):
         "Initialize the queue object."
         # TODO: Find a better way to define timeout_delay
         self.path_to_output = path_to_output
+        self.video_dir = path_to_output
         self.timeout_delay = (chunk_pause / 1000) / 2
         self.expected_frames = expected_frames
         self.trigger_mode = trigger_mode
         self.logger = logger
+        self.log_interval = log_interval
+        self.extension = extension
 
         self.videos = []
         self.video_name = ""
-        self.timestamps = {}
-        self.counter = 0  # Current frame number (total across videos)
+        self.timestamps = TimestampBuffer(expected_frames)
+        self.framerate = None
+        self.clocks = {}
+        self.writer = None
+        self.counter = 0  # Index of the next frame (total across videos)
+        self.chunk = 0  # Index of the video receiving the frames
+        self.last_pts = None
         self.chunk_counter = 0
-        self.relative_zero = 0  #  1st frame number in the current video
+        self.received = 0
+        self.first_frame_time = None
         self.frame_loss = 0
+        self.total_loss = 0
+        self.handoff_latency = Histogram(HANDOFF_BUCKETS)
         self.go = True
-        self.busy = False
+        self.time_of_last_frame = time.time()
+        self.time_of_last_summary = self.time_of_last_frame
+        self.received_at_last_summary = 0
+        self.frame_arrived = threading.Condition()
+
+        self.segmenter = None
+        if (self.expected_frames > 0) & self.trigger_mode:
+            period = 1 / frequency if frequency else 0
+            self.segmenter = ChunkSegmenter(expected_frames, period, self.timeout_delay)
 
     @property
     def video_started(self):
         "Return True if a video started."
-        return self.counter > self.relative_zero
+        return self.chunk_counter > 0
+
+    @property
+    def chunk_complete(self):
+        "Return True if the last expected frame of a triggered chunk arrived."
+        return self.segmenter is not None and self.segmenter.complete
 
     @property
     def timeout_is_exceeded(self):
@@ -286,71 +881,137 @@ class Queue:
         time_since_last_frame = time.time() - self.time_of_last_frame
         return time_since_last_frame > self.timeout_delay
 
-    def check_delay(self):
-        "Interrupts video when timeout_delay is exceeded."
-        while self.go:
-            if self.video_started and self.timeout_is_exceeded:
-                self.logger.info("Timeout delay exceeded")
-                self.go = False
-            else:
-                time.sleep(1e-6)
+    def next_frame(self, t, frame_count=-1):
+        "Return the index of a frame received at time t, placed in its chunk when triggered."
+        if self.segmenter is None:
+            frame = self.counter
+        else:
+            frame = self.segmenter.add(t, frame_count)
+        self.counter = frame + 1
+        return frame
 
-    def reset_relative_zero(self):
-        self.relative_zero = self.expected_frames * len(self.videos)
-        self.logger.info(f"relative zero: {self.relative_zero}")
+    def deadline(self):
+        "Return the time at which the current video is closed if no frame arrives."
+        if self.segmenter is None:
+            return self.time_of_last_frame + self.timeout_delay
+        return self.segmenter.deadline(self.time_of_last_frame)
+
+    def check_delay(self):
+        """Interrupts video when its last expected frame arrives or timeout_delay is exceeded.
+
+        Sleeps until the first frame of the video, then until the deadline
+        given by the last frame, which add_frame keeps pushing back, or
+        until add_frame reports that the triggered chunk is complete.
+        """
+        with self.frame_arrived:
+            while self.go:
+                if not self.video_started:
+                    self.frame_arrived.wait(self.timeout_delay)
+                    continue
+                if self.chunk_complete:
+                    self.logger.debug("Last frame of the chunk received")
+                    self.go = False
+                    break
+                remaining = self.deadline() - time.time()
+                if remaining > 0:
+                    self.frame_arrived.wait(remaining)
+                else:
+                    self.logger.info("Timeout delay exceeded")
+                    self.go = False
+
+    def log_summary(self, t, tis=None):
+        "Log the number of frames received since the last summary, instead of every frame."
+        n_frames = self.received - self.received_at_last_summary
+        message = (f"Received {n_frames} frames in {t - self.time_of_last_summary:.2f}s, "
+                   f"frame {self.counter}, {self.chunk_counter} in chunk")
+        queue_level = tis.get_queue_level() if tis is not None else None
+        if queue_level is not None:
+            message += f", {queue_level} buffers in queue"
+        self.logger.info(message)
+        self.time_of_last_summary = t
+        self.received_at_last_summary = self.received
+
+    def notify_frame(self):
+        "Wake up check_delay, called when a video starts."
+        with self.frame_arrived:
+            self.frame_arrived.notify()
+
+    def stop(self):
+        "Make check_delay return without waiting for the timeout."
+        with self.frame_arrived:
+            self.go = False
+            self.frame_arrived.notify()
 
     def reset_counters(self):
-        self.counter = self.relative_zero
+        "Start counting the frames of the next video, triggered chunks starting at a multiple of expected_frames."
+        if self.segmenter is not None:
+            self.segmenter.next_chunk()
+            self.counter = self.segmenter.first_frame
+        self.chunk += 1
         self.chunk_counter = 0
 
     def estimate_loss(self):
-        self.frame_loss = self.expected_frames - self.chunk_counter
+        "Count the frames missing from the chunk."
+        self.frame_loss = self.segmenter.loss
+        self.total_loss += self.frame_loss
 
     def log_frame_number_warning(self):
         "Log a warning with the actual and expected frame numbers."
         self.logger.warning(f"Video:                     {self.video_name}")
-        self.logger.warning(f"Number of frames:          {self.counter}")
-        self.logger.warning(f"Expected number of frames: {self.relative_zero}")
+        self.logger.warning(f"First frame:               {self.segmenter.first_frame}")
+        self.logger.warning(f"Last position received:    {self.segmenter.last_position}")
         self.logger.warning(f"Frames in chunk:           {self.chunk_counter}")
         self.logger.warning(f"Expected in chunk:         {self.expected_frames}")
         self.logger.warning(f"Frame loss:                {self.frame_loss}")
+        self.logger.warning(f"Frames after the chunk:    {self.segmenter.overflow}")
 
     def close(self):
         "Run all estimations in the right order, resets the parameters and save the timestamps"
         self.estimate_framerate()
-        if (self.expected_frames > 0) & self.trigger_mode:
+        if self.segmenter is not None and self.video_started:
             self.estimate_loss()
-
-        self.save_timestamps()
-
-        if (self.expected_frames > 0) & self.trigger_mode:
-            self.reset_relative_zero()
-            if self.frame_loss > 0:
+            if self.frame_loss > 0 or self.segmenter.overflow > 0:
                 self.log_frame_number_warning()
-            self.reset_counters()
 
+        self.save_timestamps()
+        self.reset_counters()
 
     def new_video(self):
         "Create new video name based on number of first frame."
-        self.video_name = f"{self.path_to_output}/{self.counter :06d}.avi"
+        self.video_name = f"{self.video_dir}/{self.counter :06d}.{self.extension}"
         self.videos.append(self.video_name)
 
     def estimate_framerate(self):
-        if self.video_started:
-            t0 = sorted(self.timestamps.values())[0]
-            t1 = sorted(self.timestamps.values())[-1]
-            estimate = len(self.timestamps) / (t1 - t0)
-            self.timestamps["framerate"] = estimate
-
+        self.framerate = self.timestamps.estimate_framerate()
+        if self.video_started and self.framerate is not None:
             self.logger.info(
-                f"Estimated framerate for the last video: {estimate:.2f}Hz")
+                f"Estimated framerate for the last video: {self.framerate:.2f}Hz")
+
+    def estimate_clock_offsets(self):
+        """Add the mapping between clocks to self.clocks.
+
+        The wall clock maps to running times with the (wall, clock_time,
+        base_time) triplet sampled at the end of the video, the camera clock
+        maps to running times with the median offset to the buffer PTS.
+        """
+        offset = self.timestamps.clock_offsets()
+        if offset is not None:
+            self.clocks["camera_minus_pts"] = offset
+        if "wall" in self.clocks:
+            running_time = self.clocks["clock_time"] - self.clocks["base_time"]
+            self.clocks["wall_minus_running"] = self.clocks["wall"] - running_time * 1e-9
 
     def save_timestamps(self):
-        "Write timestamps to disk in pickle format."
+        "Append the timestamps of the video to the record files of the output directory."
         if self.video_started:
-            self.timestamps["loss"] = self.frame_loss
-            with open(f'{self.video_name[:-4]}.pickle', 'wb') as handle:
-                pickle.dump(self.timestamps, handle,
-                            protocol=pickle.HIGHEST_PROTOCOL)
+            self.estimate_clock_offsets()
+            if self.writer is None:
+                self.writer = TimestampWriter(self.path_to_output)
+            # Free-running chunks are not segmented, their frames have no trigger index
+            expected_frames = self.expected_frames if self.segmenter is not None else 0
+            self.writer.write_chunk(len(self.videos) - 1, self.timestamps.view(),
+                                    expected_frames, self.frame_loss,
+                                    self.framerate, self.clocks)
             self.logger.info("Timestamps saved")
-            self.timestamps = {}
+            self.timestamps.clear()
+            self.clocks = {}
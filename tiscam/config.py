@@ -2,27 +2,141 @@
 import os
 import re
 import toml
-import json
 import logging
-import subprocess
-import tiscam.helpers
+from tiscam.discovery import get_discovery, set_provider, FakeProvider
 from pathlib import Path
 from collections.abc import Hashable
 
 
+class ConfigError(ValueError):
+    "Invalid configuration, raised when it is compiled, before the recording starts."
+
+
+# Types of the tcam properties, and the Python type of their values
+PROPERTY_TYPES = {"boolean": bool, "integer": int, "double": float, "enum": str, "string": str}
+TRUE_VALUES = ["True", "true"]
+FALSE_VALUES = ["False", "false"]
+
+
+def parse_boolean(value):
+    "Return the boolean of a configured value, None if it is not a boolean (0 and 1 are integers)."
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if value in TRUE_VALUES:
+            return True
+        if value in FALSE_VALUES:
+            return False
+    return None
+
+
+def coerce_value(name, value, property_type):
+    "Return a property value converted to the Python type of a tcam property type."
+    if property_type == "boolean":
+        boolean = parse_boolean(value)
+        if boolean is None:
+            raise ConfigError(f"{name}: {value!r} is not a boolean")
+        return boolean
+    if property_type not in PROPERTY_TYPES:
+        raise ConfigError(f"{name}: properties of type {property_type} can not be set")
+    try:
+        return PROPERTY_TYPES[property_type](value)
+    except (TypeError, ValueError):
+        raise ConfigError(f"{name}: {value!r} is not a valid {property_type}") from None
+
+
+def value_type(value):
+    "Return the tcam property type matching a configured value."
+    if parse_boolean(value) is not None:
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "double"
+    return "string"
+
+
+class PropertyPlan:
+    """Typed camera properties, applied in one batch and only when they changed.
+
+    The values are typed from the configuration when the plan is compiled,
+    then checked once against the types, ranges and menu entries reported
+    by the camera when it is first applied. The automatic modes are applied
+    before the values they control.
+
+    :param properties: merged dictionary {property name: value}
+    """
+
+    def __init__(self, properties):
+        "Type the configured values."
+        order = sorted(properties, key=lambda name: not (name.endswith(" Auto") or name.endswith(" Mode")))
+        self.values = {name: coerce_value(name, properties[name], value_type(properties[name]))
+                       for name in order}
+        self.resolved = False
+        self.applied = {}
+        self.element = None
+
+    def resolve(self, describe):
+        "Check and convert the values with the description of each property, {type, min, max, entries}."
+        errors = []
+        for name, value in self.values.items():
+            info = describe(name)
+            if info is None:
+                errors.append(f"{name}: unknown property")
+                continue
+            try:
+                value = coerce_value(name, value, info["type"])
+            except ConfigError as error:
+                errors.append(str(error))
+                continue
+            if info.get("min") is not None and info["type"] in ["integer", "double"]:
+                if not info["min"] <= value <= info["max"]:
+                    errors.append(f"{name}: {value} is out of range [{info['min']}, {info['max']}]")
+            if info.get("entries") and value not in info["entries"]:
+                errors.append(f"{name}: {value!r} is not one of {', '.join(info['entries'])}")
+            self.values[name] = value
+        if errors:
+            raise ConfigError("Invalid camera properties:\n    " + "\n    ".join(errors))
+        self.resolved = True
+
+    def update(self, properties):
+        "Change some values, applied by the next call to apply."
+        for name, value in properties.items():
+            value = coerce_value(name, value, value_type(self.values.get(name, value)))
+            self.values[name] = value
+
+    def apply(self, backend):
+        """Set the values that differ from the camera, return their names.
+
+        On the element where the plan was last applied, only the values
+        updated since are set. On a new element, the values are compared
+        to the current ones of the camera.
+        """
+        if not self.resolved:
+            self.resolve(backend.describe)
+        if backend.element is not self.element:
+            self.applied = {name: backend.get_property(name) for name in self.values}
+            self.element = backend.element
+        changed = [name for name, value in self.values.items() if self.applied.get(name) != value]
+        for name in changed:
+            backend.set_property(name, self.values[name])
+            self.applied[name] = self.values[name]
+        return changed
+
+
 class Config:
     "A class to store configuration file and ensure right formatting."
 
-    def __init__(self, config_path, serial):
-        "Initialize the object with a configuration path."
-        self.raw_config = read_config(config_path)
+    def __init__(self, config_path, serial, raw_config=None):
+        "Initialize the object with a configuration path, or an already parsed configuration."
+        self.raw_config = raw_config if raw_config is not None else read_config(config_path)
         self.config_path = config_path
         self.serial = serial
         self.apply_config()
 
         #self.set_real_framerate()
         self.set_fake_framerate()
-        self.check_exposure_time()
+        self.compile()
 
     def set_fake_framerate(self):
         self.framerate = 120
@@ -38,8 +152,8 @@ class Config:
         self.caps = {}
         self.properties = {}
         if self.serial:
-            self.caps.update(self.raw_config["tiscam"]["caps"][self.serial])
-            self.properties.update(self.raw_config["tiscam"]["properties"][self.serial])
+            self.caps.update(self.raw_config["tiscam"]["caps"].get(self.serial, {}))
+            self.properties.update(self.raw_config["tiscam"]["properties"].get(self.serial, {}))
         if self.raw_config["tiscam"]["caps"].get("common"):
             self.caps.update(self.raw_config["tiscam"]["caps"]["common"])
             self.properties.update(self.raw_config["tiscam"]["properties"]["common"])
@@ -48,25 +162,53 @@ class Config:
                        "caps": self.caps,
                        "properties": self.properties}
 
+    def compile(self):
+        "Type and check the configuration once, raising ConfigError before any recording."
+        self.plan = PropertyPlan(self.properties)
+        self.trigger_mode = self.plan.values.get("Trigger Mode", False)
+        self.check_caps()
+        self.check_pwm()
+        self.check_exposure_time()
+
+    def check_caps(self):
+        "Check that the resolution is accepted by the camera."
+        for key in ["width", "height"]:
+            if key not in self.caps:
+                raise ConfigError(f"Missing {key} in [tiscam.caps]")
+            accepted = self.caps.get(f"accepted_{key}")
+            if accepted and self.caps[key] not in accepted:
+                raise ConfigError(f"{key} {self.caps[key]} is not accepted by the camera {self.serial}, "
+                                  f"accepted: {sorted(set(accepted))}")
+
+    def check_pwm(self):
+        "Check the timing of the triggered chunks."
+        if self.trigger_mode:
+            if self.pwm["frequency"] <= 0:
+                raise ConfigError(f"pwm.frequency must be positive, not {self.pwm['frequency']}")
+            if self.pwm["chunk_size"] < 0 or self.pwm["chunk_pause"] <= 0:
+                raise ConfigError("pwm.chunk_size can not be negative and pwm.chunk_pause must be positive")
+
     def check_exposure_time(self):
         "Check that exposure time is not too long for the selected framerate"
-        exposure = int(self.properties["Exposure Time (us)"])
-        if self.properties["Trigger Mode"]:
-            fps = int(self.pwm["frequency"])
+        if "Exposure Time (us)" not in self.plan.values:
+            return
+        exposure = coerce_value("Exposure Time (us)", self.plan.values["Exposure Time (us)"], "double")
+        if exposure <= 0:
+            raise ConfigError(f"Exposure Time (us) must be positive, not {exposure}")
+        if self.trigger_mode:
+            fps = self.pwm["frequency"]
         else:
-            fps = int(self.caps["framerate"])
+            fps = self.caps["framerate"]
 
         max_fps = 1e6 / exposure
 
         if fps > max_fps:
             max_exposure = 1e6 / fps
-            logging.error(f"Exposure Time is too long for your framerate!")
-            logging.error(f"Selected exposure: {exposure}us -> max framerate possible: {max_fps}Hz")
-            logging.error(f"Desired framerate: {fps}Hz -> max exposure required: {(max_exposure):.1f}us")
-            ignore = helpers.ask_yes_or_no("Do you want to start the recording anyway? ")
-            if not ignore:
-                raise Exception("Excecution interrupted by user")
-            
+            raise ConfigError("Exposure Time is too long for your framerate! "
+                              f"Selected exposure: {exposure}us -> max framerate possible: {max_fps:.1f}Hz, "
+                              f"desired framerate: {fps}Hz -> max exposure required: {max_exposure:.1f}us")
+
+
 def read_config(path):
     "Read the configuration file."
     try:
@@ -79,44 +221,16 @@ def read_config(path):
 
 
 def get_serials():
-    "Uses tcam commands to retrieve cameras serials"
-    ps = subprocess.Popen(('tcam-ctrl', '-l'), stdout=subprocess.PIPE)
-    serials = subprocess.check_output(("awk", "{print $5}"), stdin=ps.stdout)
-    ps.wait()
-    serials = serials.decode(encoding='UTF-8').split('\n')[:-1]
-    return serials
+    "Return the serials of the connected cameras."
+    return get_discovery().serials()
 
 def get_camera_config(serial):
-    "Uses tcam commands to retrieve cameras configurations given the serial"
-    os.system(f"tcam-ctrl --save {serial} > {serial}_conf.json")
-    with open(f"{serial}_conf.json", "r") as f:
-            conf = json.load(f)
-    os.system(f"rm {serial}_conf.json")
-    return conf
+    "Return the properties of a camera given the serial, as {'properties': {...}}."
+    return {"properties": get_discovery().probe(serial)["properties"]}
 
 def get_caps(serial):
-    "Uses tcam commands to retrieve cameras caps given the serial"
-    os.system(f"tcam-ctrl --caps {serial} > {serial}_caps.txt")
-    all_caps = open(f"{serial}_caps.txt").read().split('\n')[1:-1]
-
-    caps = {"accepted_width":[], "accepted_height":[]}
-
-    for single_caps in all_caps:
-        elements = single_caps.split(',')
-        width = elements[2].split('=')[1]
-        height = elements[3].split('=')[1]
-
-        caps["accepted_width"].append(int(width))
-        caps["accepted_height"].append(int(height))
-        caps["color"] = True if ("rggb" in elements[1]) else False
-
-    caps["accepted_width"] = sorted(caps["accepted_width"], reverse=True)
-    caps["accepted_height"] = sorted(caps["accepted_height"], reverse=True)
-    caps["width"] = max(caps["accepted_width"])
-    caps["height"] = max(caps["accepted_height"])
-    caps["serial"] = serial
-    os.system(f"rm {serial}_caps.txt")
-    return caps
+    "Return the caps of a camera given the serial."
+    return get_discovery().probe(serial)["caps"]
 
 
 def get_pwm():
@@ -141,6 +255,8 @@ def get_logging():
     logging["stream_level"] = "info"
     logging["file_level"] = "debug"
     logging["gst_level"] = 1
+    logging["asynchronous"] = True
+    logging["summary_interval"] = 1
     return logging
 
 def get_pipeline():
@@ -148,9 +264,83 @@ def get_pipeline():
     pipeline = {}
     pipeline["max_buffers_queue"] = 30
     pipeline["compression_level"] = 0
+    pipeline["persistent"] = False
+    pipeline["source"] = "tcambin"
+    pipeline["encoder"] = "x264"
+    pipeline["capture_format"] = "bgrx"
+    pipeline["writer"] = "mux"
+    pipeline["tracing"] = False
+    pipeline["x264"] = {"preset": "ultrafast", "tune": "zerolatency", "threads": 0,
+                        "sliced_threads": True}
+    pipeline["ffv1"] = {"threads": 0, "slices": 0}
+    pipeline["scheduling"] = {"enabled": False, "capture_cores": [], "encoder_cores": [],
+                              "capture_priority": 0, "encoder_threads": 0}
     return pipeline
 
 
+def get_backpressure():
+    "Return standard backpressure parameters for cameras"
+    backpressure = {}
+    backpressure["policy"] = "block"
+    backpressure["interval"] = 1
+    backpressure["memory_budget"] = 1024
+    backpressure["staging_dir"] = "/dev/shm/tiscam"
+    backpressure["staging_reserve"] = 256
+    return backpressure
+
+
+def get_tap():
+    "Return standard frame tap parameters, disabled"
+    tap = {}
+    tap["enabled"] = False
+    tap["batch_size"] = 1
+    tap["batch_timeout"] = 0.1
+    tap["max_rate"] = 0
+    tap["max_buffers"] = 2
+    return tap
+
+
+def get_preview():
+    "Return standard preview parameters, disabled"
+    preview = {}
+    preview["enabled"] = False
+    preview["attached"] = False
+    preview["width"] = 640
+    preview["height"] = 360
+    preview["max_fps"] = 10
+    preview["max_cpu"] = 0.1
+    preview["sink"] = "autovideosink sync=false"
+    return preview
+
+
+def get_disk():
+    "Return standard disk writer parameters, disabled"
+    disk = {}
+    disk["enabled"] = False
+    disk["write_size"] = 4
+    disk["preallocate"] = 64
+    disk["reserve"] = 2048
+    disk["margin"] = 1.25
+    disk["policy"] = "stop"
+    disk["roots"] = []
+    return disk
+
+
+def get_start():
+    "Return standard start parameters, started at once"
+    start = {}
+    start["armed"] = False
+    start["address"] = ""
+    start["preroll_timeout"] = 5
+    start["report_timeout"] = 10
+    return start
+
+
+def get_metrics():
+    "Return the default metrics endpoint, disabled"
+    return {"address": ""}
+
+
 def create_config():
     "Create a config file with default parameters from a camera serial."
     serials = get_serials()
@@ -163,7 +353,15 @@ def create_config():
     config["path"] = get_path()
     config["logging"] = get_logging()
     config["pipeline"] = get_pipeline()
-
+    config["backpressure"] = get_backpressure()
+    config["metrics"] = get_metrics()
+    config["tap"] = get_tap()
+    config["preview"] = get_preview()
+    config["disk"] = get_disk()
+    config["start"] = get_start()
+
+    # Probe all the cameras at once, get_caps and get_camera_config then read the cache
+    get_discovery().probe_all(serials)
     for s in serials:
         config["caps"][s] = get_caps(s)
         config["properties"][s] = get_camera_config(s)["properties"]
@@ -224,9 +422,14 @@ if __name__ == "__main__":
                         help="Path where to write the config file",
                         dest="filename", default="configs.toml",
                         type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("--fake",
+                        help="Create the config file for N emulated cameras (test0, test1...)",
+                        dest="n_fake", default=0, type=int)
 
     args = parser.parse_args()
     filename = args.filename
+    if args.n_fake > 0:
+        set_provider(FakeProvider.with_cameras(args.n_fake))
 
     if os.path.isfile(filename):
         update_config(filename)
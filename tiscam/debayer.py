@@ -0,0 +1,87 @@
+"""
+Debayer and transcode videos recorded with capture_format = "bayer".
+
+The Bayer frames, stored as GRAY8 with their caps in caps.json, are
+decoded, debayered and encoded again by one gst-launch-1.0 process per
+chunk, several chunks being processed in parallel.
+"""
+import os
+import json
+import shlex
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from tiscam.encoders import encoder_stage, CAPS_FILE
+
+
+def read_bayer_caps(camera_dir):
+    "Return the Bayer caps metadata saved by the recorder."
+    with (Path(camera_dir) / CAPS_FILE).open("r") as f:
+        return json.load(f)
+
+
+def transcode_command(video, output, bayer_format, encoder, options, compression_level):
+    "Return the gst-launch-1.0 command debayering a video."
+    p = f"filesrc location={shlex.quote(str(video))} ! decodebin"
+    p += f" ! capssetter join=false caps=video/x-bayer,format={bayer_format}"
+    p += " ! bayer2rgb ! videoconvert"
+    p += " ! " + encoder_stage(encoder, options, compression_level)
+    p += f" ! matroskamux ! filesink location={shlex.quote(str(output))}"
+    return ["gst-launch-1.0", "-q"] + shlex.split(p)
+
+
+def transcode(video, output, bayer_format, encoder, options, compression_level):
+    "Debayer a video, return its path and the error message if it failed."
+    command = transcode_command(video, output, bayer_format, encoder, options, compression_level)
+    result = subprocess.run(command, capture_output=True, text=True)
+    return video, result.stderr if result.returncode else None
+
+
+def debayer_camera(camera_dir, output_dir=None, encoder="x264", options=None,
+                   compression_level=0, workers=None):
+    "Debayer every video of a camera directory in parallel, return the failed videos."
+    camera_dir = Path(camera_dir)
+    output_dir = Path(output_dir) if output_dir else camera_dir / "debayered"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    bayer_format = read_bayer_caps(camera_dir)["format"]
+    # One encoder thread per process, the parallelism comes from the chunks
+    options = {"threads": 1, **(options or {})}
+
+    videos = sorted(camera_dir.glob("*.avi"))
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(transcode, v, output_dir / f"{v.stem}.mkv", bayer_format,
+                               encoder, options, compression_level) for v in videos]
+        results = [f.result() for f in futures]
+    return {video: error for video, error in results if error is not None}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("camera_dirs", nargs="+",
+                        help="Camera directories containing Bayer videos and caps.json",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-o", "--output-dir",
+                        help="Output directory (default: debayered/ in each camera directory)",
+                        dest="output_dir", default=None,
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-e", "--encoder",
+                        help="Encoder of the debayered videos",
+                        dest="encoder", default="x264")
+    parser.add_argument("-q", "--compression-level",
+                        help="Quantizer of the lossy encoders, 0 is lossless",
+                        dest="compression_level", default=0, type=int)
+    parser.add_argument("-j", "--workers",
+                        help="Number of videos processed in parallel (default: number of cores)",
+                        dest="workers", default=None, type=int)
+    args = parser.parse_args()
+
+    for camera_dir in args.camera_dirs:
+        output_dir = args.output_dir / camera_dir.name if args.output_dir else None
+        failed = debayer_camera(camera_dir, output_dir, args.encoder,
+                                compression_level=args.compression_level, workers=args.workers)
+        for video, error in failed.items():
+            print(f"{video}: {error}")
+        print(f"{camera_dir}: done, {len(failed)} failed")
@@ -0,0 +1,220 @@
+"""
+Discovery of the cameras and of their capabilities, in process.
+
+The connected cameras are listed by the GStreamer device monitor (the
+tcam device provider), falling back to tcamsrc when the provider is not
+installed. Their caps come with the device, their properties are read by
+opening each camera with tcamsrc, which is the slow part, so the cameras
+are probed concurrently and the results are cached by serial.
+
+A provider gives the serials, caps and properties of the cameras. FakeProvider
+emulates cameras without tiscamera or hardware:
+
+    python -m tiscam.discovery [--fake 3] [-j workers]
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEVICE_CLASS = "Video/Source/tcam"
+
+FAKE_PROPERTIES = {"Exposure Time (us)": 1000,
+                   "Exposure Auto": False,
+                   "Gain": 0,
+                   "Gain Auto": False,
+                   "Trigger Mode": False}
+FAKE_CAPS = [{"format": "rggb", "width": 1920, "height": 1080},
+             {"format": "rggb", "width": 1280, "height": 720},
+             {"format": "rggb", "width": 640, "height": 480}]
+
+
+def format_caps(serial, formats):
+    "Return the caps entry of a camera in the configuration from its formats [{format, width, height}]."
+    caps = {"accepted_width": sorted({f["width"] for f in formats}, reverse=True),
+            "accepted_height": sorted({f["height"] for f in formats}, reverse=True),
+            "color": any("rggb" in f["format"] for f in formats)}
+    caps["width"] = max(caps["accepted_width"])
+    caps["height"] = max(caps["accepted_height"])
+    caps["serial"] = serial
+    return caps
+
+
+class TcamProvider:
+    "Cameras of tiscamera, through the GStreamer device monitor and tcamsrc."
+
+    def __init__(self):
+        "Initialize GStreamer, only needed for real cameras."
+        import gi
+        gi.require_version("Gst", "1.0")
+        gi.require_version("Tcam", "0.1")
+        from gi.repository import Gst, Tcam  # noqa F401, Tcam registers the property interface
+        self.Gst = Gst
+        Gst.init(None)
+        self.devices = {}
+
+    def serials(self):
+        "Return the serials of the connected cameras."
+        monitor = self.Gst.DeviceMonitor.new()
+        monitor.add_filter(DEVICE_CLASS, None)
+        monitor.start()
+        try:
+            devices = monitor.get_devices()
+        finally:
+            monitor.stop()
+        self.devices = {}
+        for device in devices:
+            properties = device.get_properties()
+            if properties is not None and properties.has_field("serial"):
+                self.devices[properties.get_string("serial")] = device
+        if self.devices:
+            return list(self.devices)
+        # The tcam device provider is not installed
+        source = self.Gst.ElementFactory.make("tcamsrc")
+        return list(source.get_device_serials())
+
+    def formats(self, serial, source=None):
+        "Return the formats [{format, width, height}] of a camera, from its device or its opened source."
+        if serial in self.devices:
+            caps = self.devices[serial].get_caps()
+        else:
+            caps = source.get_static_pad("src").query_caps(None)
+        formats = []
+        for i in range(caps.get_size()):
+            structure = caps.get_structure(i)
+            has_width, width = structure.get_int("width")
+            has_height, height = structure.get_int("height")
+            if has_width and has_height:
+                formats.append({"format": structure.get_string("format") or structure.get_name(),
+                                "width": width, "height": height})
+        return formats
+
+    def probe(self, serial):
+        "Open a camera and return its formats and properties."
+        source = self.Gst.ElementFactory.make("tcamsrc")
+        source.set_property("serial", serial)
+        source.set_state(self.Gst.State.READY)
+        try:
+            source.get_state(self.Gst.CLOCK_TIME_NONE)
+            properties = {}
+            for name in source.get_tcam_property_names():
+                prop = source.get_tcam_property(name)
+                if prop[0] and prop.type != "button":
+                    properties[name] = prop.value
+            return self.formats(serial, source), properties
+        finally:
+            source.set_state(self.Gst.State.NULL)
+
+
+class FakeProvider:
+    """Emulated cameras, with the probing time of real ones.
+
+    :param devices: dictionary {serial: {"formats": [...], "properties": {...}}}
+    :param delay: time (in s) taken to probe each camera
+    """
+
+    def __init__(self, devices, delay=0):
+        "Store the emulated cameras."
+        self.devices = devices
+        self.delay = delay
+
+    @classmethod
+    def with_cameras(cls, n_cameras, delay=0, prefix="test"):
+        "Return a provider of n identical cameras named like the test sources of record_all."
+        devices = {f"{prefix}{i}": {"formats": FAKE_CAPS, "properties": FAKE_PROPERTIES}
+                   for i in range(n_cameras)}
+        return cls(devices, delay)
+
+    def serials(self):
+        "Return the serials of the emulated cameras."
+        return list(self.devices)
+
+    def probe(self, serial):
+        "Return the formats and properties of an emulated camera."
+        if serial not in self.devices:
+            raise KeyError(f"No camera with serial {serial}")
+        time.sleep(self.delay)
+        device = self.devices[serial]
+        return [dict(f) for f in device["formats"]], dict(device["properties"])
+
+
+class Discovery:
+    """Probe cameras concurrently and cache the results by serial.
+
+    :param provider: TcamProvider or FakeProvider
+    :param workers: maximum number of cameras probed at the same time
+    """
+
+    def __init__(self, provider, workers=8):
+        "Start with an empty cache."
+        self.provider = provider
+        self.workers = workers
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def serials(self):
+        "Return the serials of the connected cameras."
+        return self.provider.serials()
+
+    def probe(self, serial, refresh=False):
+        "Return the caps and properties of a camera, probing it unless cached."
+        with self.lock:
+            if serial in self.cache and not refresh:
+                return self.cache[serial]
+        formats, properties = self.provider.probe(serial)
+        result = {"caps": format_caps(serial, formats), "properties": properties}
+        with self.lock:
+            self.cache[serial] = result
+        return result
+
+    def probe_all(self, serials=None, refresh=False):
+        "Return {serial: {caps, properties}} of the cameras, all connected ones if serials is None."
+        serials = self.serials() if serials is None else serials
+        if not serials:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(serials))) as pool:
+            results = pool.map(lambda s: self.probe(s, refresh), serials)
+            return dict(zip(serials, results))
+
+
+_discovery = None
+
+
+def get_discovery():
+    "Return the discovery shared by the configuration functions, probing real cameras by default."
+    global _discovery
+    if _discovery is None:
+        _discovery = Discovery(TcamProvider())
+    return _discovery
+
+
+def set_provider(provider, workers=8):
+    "Make the configuration functions use another provider, FakeProvider for tests."
+    global _discovery
+    _discovery = Discovery(provider, workers)
+    return _discovery
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fake", help="Emulate N cameras instead of probing the real ones",
+                        dest="n_fake", default=0, type=int)
+    parser.add_argument("--fake-delay", help="Probing time of each emulated camera (s)",
+                        dest="fake_delay", default=1, type=float)
+    parser.add_argument("-j", "--workers", help="Maximum number of cameras probed at the same time",
+                        dest="workers", default=8, type=int)
+    args = parser.parse_args()
+
+    if args.n_fake > 0:
+        discovery = set_provider(FakeProvider.with_cameras(args.n_fake, args.fake_delay), args.workers)
+    else:
+        discovery = set_provider(TcamProvider(), args.workers)
+
+    t0 = time.perf_counter()
+    cameras = discovery.probe_all()
+    print(f"Probed {len(cameras)} cameras in {time.perf_counter() - t0:.2f}s")
+    for serial, camera in cameras.items():
+        caps = camera["caps"]
+        print(f"{serial}: {caps['width']}x{caps['height']} {'color' if caps['color'] else 'mono'}, "
+              f"{len(caps['accepted_width'])} widths, {len(camera['properties'])} properties")
@@ -0,0 +1,272 @@
+"""
+Disk writer of the encoded chunks, with preallocation and a free-space guard.
+
+When enabled in [tiscam.disk], the chunks are written by tiscamsink
+instead of filesink: each file is preallocated (posix_fallocate) for the
+predicted chunk size, the largest recent chunk plus a margin, so it does not
+grow block by block, and the data is written in blocks of write_size MB,
+the allocation beyond the data being released when the file is closed.
+
+Before each chunk, the guard checks that the disk holds the predicted
+chunk plus `reserve` MB. Otherwise, with the "stop" policy the camera
+stops after finalizing its current chunk, and with the "switch" policy the
+next chunks are written to the next root of `roots` with enough space. The
+camera directories are spread across `roots` when it is set.
+"""
+import os
+import time
+import collections
+from pathlib import Path
+
+import gi
+gi.require_version("Gst", "1.0")
+gi.require_version("GstBase", "1.0")
+from gi.repository import GLib, GObject, Gst, GstBase
+
+MB = 1 << 20
+POLICIES = ["stop", "switch"]
+ELEMENT_NAME = "tiscamsink"
+
+
+def free_space(path):
+    "Return the space (in bytes) available to the user on the disk of path."
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def spread_root(roots, index):
+    "Return the output root of the index-th camera, the cameras being spread across the roots."
+    return roots[index % len(roots)]
+
+
+class DiskGuard:
+    """Predict the size of the chunks of a camera and check the free space before each one.
+
+    :param logger: logger of the camera
+    :param write_size: size (in MB) of the writes of tiscamsink
+    :param preallocate: size (in MB) preallocated for the first chunk, before any chunk was measured
+    :param reserve: space (in MB) left free on the disk
+    :param margin: ratio of the predicted chunk size to the largest recent chunk
+    :param policy: what to do when the disk is full, "stop" or "switch"
+    :param roots: output roots the chunks can be switched to
+    """
+
+    def __init__(self, logger, write_size=4, preallocate=64, reserve=2048, margin=1.25, policy="stop",
+                 roots=None):
+        "Start without measured chunks."
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown disk policy {policy}, available: {', '.join(POLICIES)}")
+        self.logger = logger
+        self.write_size = int(write_size * MB)
+        self.preallocate = int(preallocate * MB)
+        self.reserve = int(reserve * MB)
+        self.margin = margin
+        self.policy = policy
+        self.roots = [Path(r).expanduser().absolute() for r in roots or []]
+        self.chunk_sizes = collections.deque(maxlen=8)
+        self.bytes_total = 0
+        self.write_time = 0
+        self.chunk_rate = None
+        self.free = None
+        self.full = False
+
+    def predicted_size(self):
+        "Return the size (in bytes) to preallocate for the next chunk."
+        if not self.chunk_sizes:
+            return self.preallocate
+        return int(max(self.chunk_sizes) * self.margin)
+
+    @property
+    def rate(self):
+        "Return the sustained write rate (in MB/s) since the start."
+        return self.bytes_total / self.write_time / MB if self.write_time > 0 else None
+
+    def chunk_written(self, size, duration):
+        "Record the size (in bytes) of a closed chunk and the time (in s) its file was open."
+        self.chunk_sizes.append(size)
+        self.bytes_total += size
+        self.write_time += duration
+        self.chunk_rate = size / duration / MB if duration > 0 else None
+        if self.chunk_rate is not None:
+            self.logger.debug(f"Chunk of {size / MB:.1f}MB written at {self.chunk_rate:.1f}MB/s")
+
+    def record_chunk(self, path):
+        "Record the size of a closed chunk written by another sink."
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.chunk_sizes.append(size)
+
+    def has_space(self, directory):
+        "Return True if the disk of directory holds the next chunk and the reserve."
+        self.free = free_space(directory)
+        return self.free - self.predicted_size() >= self.reserve
+
+    def next_directory(self, directory):
+        """Return the directory of the next chunk, None if no disk has enough space.
+
+        With the switch policy, a full directory is replaced by the directory
+        of the same name in the next root with enough space.
+        """
+        directory = Path(directory)
+        if self.has_space(directory):
+            return directory
+        self.logger.warning(f"Only {self.free / MB:.0f}MB left for {directory}, "
+                            f"{(self.predicted_size() + self.reserve) / MB:.0f}MB needed")
+        if self.policy == "switch":
+            for root in self.roots:
+                candidate = root / directory.name
+                if candidate != directory and self.has_space(root):
+                    candidate.mkdir(parents=True, exist_ok=True)
+                    self.logger.warning(f"Switching the next chunks to {candidate}")
+                    return candidate
+        self.full = True
+        return None
+
+
+class DiskSink(GstBase.BaseSink):
+    """Sink writing to a preallocated file in large blocks.
+
+    The data is accumulated and written in multiples of write-size bytes,
+    byte segments (the muxer rewriting its header) flushing the pending
+    data and moving the write position.
+    """
+
+    __gstmetadata__ = ("Tiscam disk sink", "Sink/File",
+                       "Write to preallocated files with large writes", "tiscam")
+    __gsttemplates__ = Gst.PadTemplate.new("sink", Gst.PadDirection.SINK,
+                                           Gst.PadPresence.ALWAYS, Gst.Caps.new_any())
+    __gproperties__ = {
+        "location": (str, "Location", "Path of the file to write", None, GObject.ParamFlags.READWRITE),
+        "write-size": (int, "Write size", "Size of the writes (bytes)", 4096, 1 << 30, 4 * MB,
+                       GObject.ParamFlags.READWRITE)}
+
+    def __init__(self):
+        "Create the sink, without file."
+        super().__init__()
+        self.location = None
+        self.write_size = 4 * MB
+        self.guard = None
+        self.fd = None
+        self.pending = bytearray()
+
+    def do_get_property(self, prop):
+        "Return a property."
+        if prop.name == "location":
+            return self.location
+        if prop.name == "write-size":
+            return self.write_size
+        raise AttributeError(f"Unknown property {prop.name}")
+
+    def do_set_property(self, prop, value):
+        "Set a property."
+        if prop.name == "location":
+            self.location = value
+        elif prop.name == "write-size":
+            self.write_size = value
+        else:
+            raise AttributeError(f"Unknown property {prop.name}")
+
+    def do_start(self):
+        "Open and preallocate the file."
+        try:
+            self.fd = os.open(self.location, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except (OSError, TypeError) as error:
+            self.error(f"Could not open {self.location}: {error}")
+            return False
+        size = self.guard.predicted_size() if self.guard is not None else 0
+        if size > 0:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError as error:
+                self.warning(f"Could not preallocate {size}B for {self.location}: {error}")
+        self.pending.clear()
+        self.pending_offset = 0  # Offset in the file of the pending data
+        self.position = 0
+        self.end = 0
+        self.opened = time.perf_counter()
+        return True
+
+    def do_stop(self):
+        "Write the pending data, release the space preallocated beyond it and close the file."
+        if self.fd is None:
+            return True
+        try:
+            self.flush()
+            os.ftruncate(self.fd, self.end)
+        except OSError as error:
+            self.error(f"Could not finish {self.location}: {error}")
+        os.close(self.fd)
+        self.fd = None
+        if self.guard is not None:
+            self.guard.chunk_written(self.end, time.perf_counter() - self.opened)
+        return True
+
+    def do_render(self, buffer):
+        "Append a buffer to the pending data, writing it by blocks of write-size."
+        ok, info = buffer.map(Gst.MapFlags.READ)
+        if not ok:
+            return Gst.FlowReturn.ERROR
+        try:
+            if self.position != self.pending_offset + len(self.pending):
+                self.flush()
+                self.pending_offset = self.position
+            self.pending += info.data
+            self.position += buffer.get_size()
+            self.end = max(self.end, self.position)
+            if len(self.pending) >= self.write_size:
+                self.flush(self.write_size)
+        except OSError as error:
+            self.error(f"Could not write {self.location}: {error}")
+            return Gst.FlowReturn.ERROR
+        finally:
+            buffer.unmap(info)
+        return Gst.FlowReturn.OK
+
+    def do_event(self, event):
+        "Move the write position on byte segments."
+        if event.type == Gst.EventType.SEGMENT:
+            segment = event.parse_segment()
+            if segment.format == Gst.Format.BYTES and self.fd is not None:
+                try:
+                    self.flush()
+                except OSError as error:
+                    self.error(f"Could not write {self.location}: {error}")
+                self.position = self.pending_offset = segment.start
+        return GstBase.BaseSink.do_event(self, event)
+
+    def do_query(self, query):
+        "Tell the muxer that the file is seekable, so it rewrites its header."
+        if query.type == Gst.QueryType.SEEKING:
+            query.set_seeking(Gst.Format.BYTES, True, 0, -1)
+            return True
+        return GstBase.BaseSink.do_query(self, query)
+
+    def flush(self, block=1):
+        "Write the pending data, keeping the end that does not fill a multiple of block bytes."
+        size = len(self.pending) - len(self.pending) % block
+        view = memoryview(self.pending)[:size]
+        written = 0
+        while written < size:
+            written += os.pwrite(self.fd, view[written:], self.pending_offset + written)
+        view.release()
+        del self.pending[:size]
+        self.pending_offset += size
+
+    def warning(self, message):
+        "Post a warning message, the guard being optional."
+        error = GLib.Error.new_literal(Gst.ResourceError.quark(), message, Gst.ResourceError.WRITE)
+        self.post_message(Gst.Message.new_warning(self, error, message))
+
+    def error(self, message):
+        "Post an error message, stopping the pipeline."
+        error = GLib.Error.new_literal(Gst.ResourceError.quark(), message, Gst.ResourceError.WRITE)
+        self.post_message(Gst.Message.new_error(self, error, message))
+
+
+def register():
+    "Register tiscamsink in this process."
+    if Gst.ElementFactory.find(ELEMENT_NAME) is None:
+        GObject.type_register(DiskSink)
+        Gst.Element.register(None, ELEMENT_NAME, Gst.Rank.NONE, DiskSink)
@@ -0,0 +1,66 @@
+"""
+Encoder stages of the recording pipeline.
+
+The encoder is selected with `encoder` in [tiscam.pipeline], its options
+are read from the table of the same name, e.g. [tiscam.pipeline.x264].
+"""
+import gi
+
+gi.require_version("Gst", "1.0")
+
+from gi.repository import Gst
+
+# name: (GStreamer element, whether it records the camera stream as is)
+ENCODERS = {"x264": ("x264enc", False),
+            "ffv1": ("avenc_ffv1", False),
+            "raw": ("identity", True),
+            "vaapi": ("vaapih264enc", False),
+            "v4l2": ("v4l2h264enc", False)}
+
+# Metadata of the recorded Bayer stream, saved in each camera directory
+CAPS_FILE = "caps.json"
+
+# Encoders able to record the Bayer stream stored as GRAY8
+BAYER_ENCODERS = ["raw", "ffv1"]
+
+X264_DEFAULTS = {"preset": "ultrafast", "tune": "zerolatency", "threads": 0,
+                 "sliced_threads": True}
+FFV1_DEFAULTS = {"threads": 0, "slices": 0}
+
+
+def encoder_stage(name, options=None, compression_level=0):
+    """Return the pipeline description of an encoder, named "encoder".
+
+    :param name: one of ENCODERS
+    :param options: options from the [tiscam.pipeline.<name>] table
+    :param compression_level: quantizer of the lossy encoders, 0 is lossless
+    """
+    options = options or {}
+    q = compression_level
+    if name == "x264":
+        o = {**X264_DEFAULTS, **options}
+        sliced = "true" if o["sliced_threads"] else "false"
+        return (f"x264enc name=encoder quantizer={q} qp-min={q} qp-max={q} qp-step={q}"
+                f" speed-preset={o['preset']} tune={o['tune']} pass=qual"
+                f" sliced-threads={sliced} threads={o['threads']}")
+    if name == "ffv1":
+        o = {**FFV1_DEFAULTS, **options}
+        return f"avenc_ffv1 name=encoder threads={o['threads']} slices={o['slices']}"
+    if name == "raw":
+        return "identity name=encoder"
+    if name == "vaapi":
+        return f"vaapih264enc name=encoder rate-control=cqp init-qp={q} ! h264parse"
+    if name == "v4l2":
+        return "v4l2h264enc name=encoder ! h264parse"
+    raise ValueError(f"Unknown encoder {name}, available: {', '.join(ENCODERS)}")
+
+
+def is_passthrough(name):
+    "Return True if the encoder records the camera stream (Bayer or mono) without conversion."
+    return ENCODERS[name][1]
+
+
+def available_encoders():
+    "Return the names of the encoders whose GStreamer element is installed."
+    return [name for name, (element, _) in ENCODERS.items()
+            if Gst.ElementFactory.find(element) is not None]
@@ -1,6 +1,9 @@
 "Helper functions for parsing user input."
-import logging
 import sys
+import queue
+import atexit
+import logging
+import logging.handlers
 
 def ask_yes_or_no(message, remaining_attempts=10):
     "Prompt a message and return True if the user confirms, False else."
@@ -19,12 +22,13 @@ def ask_yes_or_no(message, remaining_attempts=10):
         return ask_yes_or_no("", remaining_attempts=remaining_attempts - 1)
 
 # If files were detected, remove it if the --force option was provided
-# If not, ask the user if we need to overwrite the directory's content.
-def clean_output_dir(path_video_folder, overwrite):
+# If not, ask the user if we need to overwrite the directory's content,
+# or refuse without asking if not interactive (armed start).
+def clean_output_dir(path_video_folder, overwrite, interactive=True):
     if path_video_folder.exists():
         files_to_remove = []
         for f in path_video_folder.iterdir():
-            if f.suffix in [".mp4", ".avi", ".pickle", ".mkv"]:
+            if f.suffix in [".mp4", ".avi", ".pickle", ".mkv", ".tsr", ".raw"] or f.name in ["analysis_cache.json", "caps.json"]:
                 files_to_remove.append(f)
         has_file = len(files_to_remove) > 0
     else:
@@ -34,6 +38,9 @@ def clean_output_dir(path_video_folder, overwrite):
 
     if has_file:
         message = f"Content detected in {path_video_folder}, do you wish to overwrite ? [Y/n]\n"  # noqa E501
+        if not overwrite and not interactive:
+            logging.error(f"Content detected in {path_video_folder}, set overwrite to replace it")
+            return False
         if overwrite or ask_yes_or_no(message):
             for f in files_to_remove:
                 f.unlink()
@@ -41,7 +48,13 @@ def clean_output_dir(path_video_folder, overwrite):
             return False
     return True
 
-def get_logger(name, stream_level, file_level, output_path):
+def get_logger(name, stream_level, file_level, output_path, asynchronous=False):
+    """Return a logger writing to output_path and stdout.
+
+    With asynchronous=True, records are pushed to a queue and the file and
+    stream handlers run in a separate thread, so logging never blocks the
+    GStreamer streaming thread on I/O.
+    """
     stream_numeric_level = getattr(logging, stream_level.upper(), 10)
     file_numeric_level = getattr(logging, file_level.upper(), 10)
 
@@ -54,12 +67,23 @@ def get_logger(name, stream_level, file_level, output_path):
     file_handler = logging.FileHandler(output_path, mode="w")
     file_handler.setLevel(level=file_numeric_level)
     file_handler.setFormatter(file_formatter)
-    root_logger.addHandler(file_handler)
 
     stream_formatter = logging.Formatter('%(name)s: %(levelname)s - %(message)s')
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setLevel(level=stream_numeric_level)
     stream_handler.setFormatter(stream_formatter)
-    root_logger.addHandler(stream_handler)
+
+    if asynchronous:
+        records = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(records)
+        queue_handler.setLevel(level=min(file_numeric_level, stream_numeric_level))
+        root_logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(records, file_handler, stream_handler,
+                                                  respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        root_logger.addHandler(file_handler)
+        root_logger.addHandler(stream_handler)
 
     return root_logger
@@ -0,0 +1,232 @@
+"""
+Live metrics of the recorders, in the Prometheus text format.
+
+The counters and gauges of every camera of the process are rendered on
+each scrape from the state of its Camera, Queue and Backpressure objects,
+nothing is computed in the recording threads except the handoff latency
+histogram. The endpoint is set with `address` in [tiscam.metrics], either
+"host:port" for HTTP or "unix:/path/to/socket" for a Unix socket:
+
+    curl http://localhost:9100/metrics
+    curl --unix-socket /tmp/tiscam.sock http://localhost/metrics
+    python -m tiscam.metrics localhost:9100
+"""
+import os
+import bisect
+import socket
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Delay (in s) between the capture of a frame (its PTS) and its handoff
+HANDOFF_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]
+
+
+class Histogram:
+    """Cumulative histogram of observations, as exported by Prometheus.
+
+    :param buckets: sorted upper bounds of the buckets, +Inf is added
+    """
+
+    def __init__(self, buckets):
+        "Create empty buckets."
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        "Add an observation."
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        "Return (upper bound, number of observations below it) for each bucket."
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+def camera_metrics(camera):
+    "Return (name, type, help, value) of every metric of a camera, skipping unknown values."
+    queue = camera.queue
+    backpressure = camera.backpressure.metrics if camera.backpressure is not None else {}
+    metrics = [("up", "gauge", "Whether the camera is recording", int(camera.running)),
+               ("armed", "gauge", "Whether the camera is prerolled and waiting for the start", int(camera.armed)),
+               ("time_to_first_frame_seconds", "gauge", "Delay between the start of the pipeline and its first frame",
+                camera.time_to_first_frame)]
+    if queue is not None:
+        metrics += [
+            ("frames_received_total", "counter", "Frames received by the identity handoff",
+             queue.received),
+            ("frames_lost_total", "counter", "Frames missing from the chunks, from the trigger count",
+             queue.total_loss),
+            ("chunk_loss", "gauge", "Frames missing from the last chunk", queue.frame_loss),
+            ("chunks_total", "counter", "Chunks started", len(queue.videos)),
+            ("framerate", "gauge", "Estimated framerate of the last chunk (Hz)", queue.framerate),
+            ("handoff_latency_seconds", "histogram", "Delay between the PTS of a frame and its handoff",
+             queue.handoff_latency)]
+    if camera.backpressure is not None:
+        metrics += [
+            ("queue_overruns_total", "counter", "Times the queue before the encoder was full",
+             camera.backpressure.overruns),
+            ("frames_encoded_total", "counter", "Frames output by the encoder",
+             camera.backpressure.frames_encoded),
+            ("bytes_written_total", "counter", "Bytes written by the sink",
+             camera.backpressure.bytes_total)]
+    metrics += [
+        ("queue_depth", "gauge", "Buffers in the queue before the encoder",
+         backpressure.get("queue_buffers")),
+        ("queue_size", "gauge", "Maximum number of buffers in the queue",
+         backpressure.get("queue_size")),
+        ("encoder_fps", "gauge", "Frames per second output by the encoder",
+         backpressure.get("encoder_fps")),
+        ("encoder_latency_seconds", "gauge", "Mean time spent by a frame in the encoder",
+         backpressure.get("encoder_latency_mean")),
+        ("write_rate_bytes", "gauge", "Bytes per second written by the sink",
+         backpressure["write_rate"] * 1e6 if "write_rate" in backpressure else None)]
+    if camera.preview is not None:
+        metrics += [
+            ("preview_attached", "gauge", "Whether the preview is linked", int(camera.preview.attached)),
+            ("preview_fps", "gauge", "Maximum framerate of the preview", camera.preview.fps),
+            ("preview_cpu", "gauge", "CPU used by the preview branch (fraction of one core)",
+             camera.preview.cpu)]
+    if camera.disk is not None:
+        metrics += [
+            ("disk_write_rate_bytes", "gauge", "Sustained write rate of the chunks to the disk",
+             camera.disk.rate * 1e6 if camera.disk.rate is not None else None),
+            ("disk_free_bytes", "gauge", "Free space on the disk at the last chunk", camera.disk.free),
+            ("disk_predicted_chunk_bytes", "gauge", "Space preallocated for the next chunk",
+             camera.disk.predicted_size()),
+            ("disk_full", "gauge", "Whether the camera stopped for lack of disk space", int(camera.disk.full))]
+    return [m for m in metrics if m[3] is not None]
+
+
+def render(cameras, prefix="tiscam"):
+    "Return the metrics of the cameras {serial: Camera} in the Prometheus text format."
+    families = {}
+    for serial, camera in cameras.items():
+        for name, kind, description, value in camera_metrics(camera):
+            families.setdefault(name, (kind, description, []))[2].append((serial, value))
+
+    lines = []
+    for name, (kind, description, samples) in families.items():
+        name = f"{prefix}_{name}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for serial, value in samples:
+            label = f'camera="{serial}"'
+            if kind == "histogram":
+                for bound, count in value.cumulative_counts():
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f"{name}_sum{{{label}}} {value.sum}")
+                lines.append(f"{name}_count{{{label}}} {value.count}")
+            else:
+                lines.append(f"{name}{{{label}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    "Answer GET /metrics with the metrics of the cameras of the server."
+
+    def do_GET(self):
+        "Send the metrics."
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = render(self.server.cameras).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        "Return the client address, empty for Unix sockets."
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        "Do not log the scrapes."
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    "HTTP server listening on a Unix socket."
+    daemon_threads = True
+
+
+def parse_address(address):
+    "Return (host, port) or the path of the Unix socket of an address."
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+class MetricsServer:
+    """Serve the metrics of cameras from a background thread.
+
+    :param cameras: dictionary {serial: Camera}, read on each scrape
+    :param address: "host:port" or "unix:/path/to/socket"
+    """
+
+    def __init__(self, cameras, address):
+        "Bind the server."
+        self.address = parse_address(address)
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = UnixHTTPServer(self.address, MetricsHandler)
+        else:
+            self.server = ThreadingHTTPServer(self.address, MetricsHandler)
+        self.server.cameras = cameras
+        self.thread = None
+
+    def start(self):
+        "Start serving in a daemon thread."
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "Stop serving and remove the Unix socket."
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def scrape(address, timeout=5):
+    "Return the metrics text served at an address."
+    address = parse_address(address)
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(address)
+        s.sendall(b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n")
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = b"".join(chunks)
+    header, _, body = response.partition(b"\r\n\r\n")
+    status = header.split(b"\r\n")[0].decode()
+    if " 200 " not in status:
+        raise RuntimeError(f"Scrape of {address} failed: {status}")
+    return body.decode()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("address", help='Address of the recorder, "host:port" or "unix:/path"')
+    args = parser.parse_args()
+    print(scrape(args.address), end="")
@@ -0,0 +1,193 @@
+"""
+Live preview of a camera during the recording.
+
+When the preview is enabled in [tiscam.preview], the pipeline has a tee
+after its first capsfilter, where a preview branch can be linked and
+unlinked at any time without stopping the recording branch: send SIGUSR1
+to the recorder to toggle it. The branch only receives max_fps frames per
+second, dropped before its leaky queue, and scales them down before
+converting them. The CPU used by its thread is sampled every second and
+the preview framerate is halved while it is above max_cpu (a fraction of
+one core). Set sink = "fakesink sync=false" to check it without display.
+"""
+import os
+import time
+import threading
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+TEE_NAME = "branchtee"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def thread_cpu_time(name):
+    "Return the CPU time (in s) used by the streaming threads of the pads of an element."
+    total = 0
+    for task in os.scandir("/proc/self/task"):
+        try:
+            with open(f"{task.path}/comm") as f:
+                if not f.read().startswith(f"{name}:"):
+                    continue
+            with open(f"{task.path}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue  # The thread ended meanwhile
+        total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime, stime
+    return total
+
+
+class Preview:
+    """Preview branch linked to and unlinked from the tee of a running pipeline.
+
+    :param logger: logger of the camera
+    :param name: name of the camera, unique in the process
+    :param width: width of the preview
+    :param height: height of the preview
+    :param max_fps: maximum framerate of the preview
+    :param max_cpu: CPU (fraction of one core) above which the framerate is lowered
+    :param sink: description of the sink element
+    :param attached: whether the preview is linked when the recording starts
+    :param interval: interval (in s) between two samples of the CPU usage
+    """
+
+    def __init__(self, logger, name, width=640, height=360, max_fps=10, max_cpu=0.1,
+                 sink="autovideosink sync=false", attached=False, interval=1):
+        "Store the parameters, the branch being created once a pipeline is set."
+        self.logger = logger
+        # Name of the queue of the branch, and of its streaming thread (15 characters at most)
+        self.queue_name = f"pv{name.split('_')[-1]}"[:11]
+        self.width = width
+        self.height = height
+        self.max_fps = max_fps
+        self.max_cpu = max_cpu
+        self.sink = sink
+        self.wanted = attached
+        self.interval = interval
+        self.fps = max_fps
+        self.cpu = 0
+        self.pipeline = None
+        self.tee = None
+        self.bayer = False
+        self.bin = None
+        self.pad = None
+        self.last_frame = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    @property
+    def attached(self):
+        "Return True if the preview branch is linked."
+        return self.bin is not None
+
+    def description(self, bayer):
+        "Return the description of the preview branch."
+        p = f"queue name={self.queue_name} leaky=downstream max-size-buffers=1 max-size-bytes=0 max-size-time=0"
+        if bayer:
+            p += " ! bayer2rgb ! videoscale method=0 ! videoconvert"
+        else:
+            p += " ! videoscale method=0 ! videoconvert"
+        p += f" ! video/x-raw,width={self.width},height={self.height}"
+        p += f" ! {self.sink}"
+        return p
+
+    def set_pipeline(self, pipeline, bayer=False):
+        "Use the tee of a newly created pipeline, linking the preview if it is wanted."
+        with self.lock:
+            self.stop_monitor()
+            self.pipeline = pipeline
+            self.tee = pipeline.get_by_name(TEE_NAME)
+            self.bayer = bayer
+            self.bin = None
+            self.pad = None
+            if self.wanted:
+                self.link()
+
+    def attach(self):
+        "Link the preview branch to the running pipeline."
+        with self.lock:
+            self.wanted = True
+            if self.tee is not None and self.bin is None:
+                self.link()
+                self.logger.info("Preview attached")
+
+    def detach(self):
+        "Unlink the preview branch, the recording branch keeping streaming."
+        with self.lock:
+            self.wanted = False
+            if self.bin is not None:
+                self.unlink()
+                self.logger.info("Preview detached")
+
+    def toggle(self):
+        "Attach the preview if it is detached, detach it otherwise."
+        if self.attached:
+            self.detach()
+        else:
+            self.attach()
+
+    def link(self):
+        "Create the branch and link it to a new src pad of the tee."
+        self.bin = Gst.parse_bin_from_description(self.description(self.bayer), True)
+        self.pipeline.add(self.bin)
+        self.pad = self.tee.get_request_pad("src_%u")
+        self.pad.add_probe(Gst.PadProbeType.BUFFER, self.decimate)
+        self.pad.link(self.bin.get_static_pad("sink"))
+        self.bin.sync_state_with_parent()
+        self.fps = self.max_fps
+        self.start_monitor()
+
+    def unlink(self, timeout=1):
+        "Unlink the branch once no buffer is flowing through the tee pad, then remove it."
+        self.stop_monitor()
+        pad, branch = self.pad, self.bin
+        self.pad = self.bin = None
+        unlinked = threading.Event()
+
+        def on_idle(pad, info):
+            pad.unlink(branch.get_static_pad("sink"))
+            unlinked.set()
+            return Gst.PadProbeReturn.REMOVE
+
+        pad.add_probe(Gst.PadProbeType.IDLE, on_idle)
+        if not unlinked.wait(timeout):
+            self.logger.warning("The preview branch was not idle, removed anyway")
+        branch.set_state(Gst.State.NULL)
+        self.pipeline.remove(branch)
+        self.tee.release_request_pad(pad)
+
+    def decimate(self, pad, info):
+        "Drop the frames exceeding the preview framerate before they reach its queue."
+        now = time.perf_counter()
+        if now - self.last_frame < 1 / self.fps:
+            return Gst.PadProbeReturn.DROP
+        self.last_frame = now
+        return Gst.PadProbeReturn.OK
+
+    def start_monitor(self):
+        "Start sampling the CPU used by the preview thread."
+        self.stopped.clear()
+        self.monitor = threading.Thread(target=self.run, name=f"{self.logger.name}-preview", daemon=True)
+        self.monitor.start()
+
+    def stop_monitor(self):
+        "Stop sampling the CPU."
+        self.stopped.set()
+        if self.monitor is not None and self.monitor is not threading.current_thread():
+            self.monitor.join()
+        self.monitor = None
+
+    def run(self):
+        "Sample the CPU of the preview thread and adapt its framerate to max_cpu."
+        cpu_time, t = thread_cpu_time(self.queue_name), time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            new_cpu_time, now = thread_cpu_time(self.queue_name), time.perf_counter()
+            self.cpu = (new_cpu_time - cpu_time) / (now - t)
+            cpu_time, t = new_cpu_time, now
+            if self.cpu > self.max_cpu and self.fps > 1:
+                self.fps = max(self.fps / 2, 1)
+                self.logger.info(f"Preview uses {self.cpu:.0%} of a core, lowered to {self.fps:.1f} fps")
+            elif self.cpu < self.max_cpu / 2 and self.fps < self.max_fps:
+                self.fps = min(self.fps * 2, self.max_fps)
@@ -0,0 +1,163 @@
+"""
+Memory-mapped raw frame files, written without encoding.
+
+A chunk file is preallocated for the expected number of frames and laid out as
+
+    header | frame data (capacity x frame_size) | index table (capacity records)
+
+The header holds the number of frames written and a JSON description of the
+frames, the index table holds the frame index and handoff time given by the
+recorder and the timestamps of each frame. When a chunk has more frames than
+expected, the file is extended and the index table moved to its new end. A
+chunk is read back as a NumPy view on the mapped file.
+"""
+import os
+import json
+import mmap
+import numpy as np
+from pathlib import Path
+
+MAGIC = b"TISCAMRW"
+VERSION = 1
+HEADER_SIZE = mmap.PAGESIZE
+COUNT_OFFSET = 16  # uint64 number of frames, after magic and header length
+JSON_OFFSET = 24
+
+# Chunk capacity when the number of frames per chunk is unknown (no trigger)
+DEFAULT_CAPACITY = 256
+# Handed off frames waiting for the appsink, matched with their index by PTS
+PENDING_FRAMES = 1024
+
+BYTES_PER_PIXEL = {"GRAY8": 1, "GRAY16_LE": 2, "BGRx": 4, "BGRA": 4}
+
+INDEX_DTYPE = np.dtype([("frame", np.int64),
+                        ("wall", np.float64),
+                        ("pts", np.uint64),
+                        ("camera_time", np.int64),
+                        ("frame_count", np.int64)])
+
+
+def align(size, alignment=mmap.PAGESIZE):
+    "Round size up to a multiple of alignment."
+    return -(-size // alignment) * alignment
+
+
+class RawChunkWriter:
+    """Write the frames of a chunk in a preallocated memory-mapped file.
+
+    :param path: path of the chunk file
+    :param capacity: number of frames to preallocate, usually pwm.chunk_size
+    :param frame_size: size of a frame in bytes
+    :param metadata: description of the frames (caps, width, height, format...)
+    """
+
+    def __init__(self, path, capacity, frame_size, metadata):
+        "Create and map the chunk file."
+        self.path = Path(path)
+        self.capacity = max(capacity, 1)
+        self.frame_size = frame_size
+        self.metadata = dict(metadata, version=VERSION, frame_size=frame_size)
+        self.n_frames = 0
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.map(self.capacity)
+        self.mm[:len(MAGIC)] = MAGIC
+        self.mm[len(MAGIC):COUNT_OFFSET] = np.array([HEADER_SIZE, 0], dtype=np.uint32).tobytes()
+
+    @property
+    def index_offset(self):
+        "Return the offset of the index table."
+        return align(HEADER_SIZE + self.capacity * self.frame_size)
+
+    def map(self, capacity):
+        "Preallocate the file for capacity frames and map it."
+        self.capacity = capacity
+        size = self.index_offset + align(capacity * INDEX_DTYPE.itemsize)
+        os.posix_fallocate(self.fd, 0, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.frames = np.ndarray((capacity, self.frame_size), dtype=np.uint8,
+                                 buffer=self.mm, offset=HEADER_SIZE)
+        self.index = np.ndarray(capacity, dtype=INDEX_DTYPE,
+                                buffer=self.mm, offset=self.index_offset)
+        self.count = np.ndarray(1, dtype=np.uint64, buffer=self.mm, offset=COUNT_OFFSET)
+        self.write_metadata()
+
+    def write_metadata(self):
+        "Write the JSON description of the chunk in the header."
+        self.metadata.update(capacity=self.capacity, index_offset=self.index_offset,
+                             data_offset=HEADER_SIZE)
+        description = json.dumps(self.metadata).encode()
+        if JSON_OFFSET + len(description) > HEADER_SIZE:
+            raise ValueError("Metadata too long for the header")
+        self.mm[JSON_OFFSET:JSON_OFFSET + len(description)] = description
+        self.mm[JSON_OFFSET + len(description):HEADER_SIZE] = bytes(
+            HEADER_SIZE - JSON_OFFSET - len(description))
+
+    def grow(self):
+        "Double the capacity, moving the index table to the new end of the file."
+        index = self.index[:self.n_frames].copy()
+        self.release()
+        self.map(self.capacity * 2)
+        self.index[:len(index)] = index
+
+    def write(self, data, frame, wall, pts, camera_time=-1, frame_count=-1):
+        "Copy a mapped frame in the next slot and record its timestamps."
+        if self.n_frames >= self.capacity:
+            self.grow()
+        i = self.n_frames
+        self.frames[i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.index[i] = (frame, wall, pts, camera_time, frame_count)
+        self.n_frames += 1
+        self.count[0] = self.n_frames
+
+    def release(self):
+        "Unmap the file, the views on it must not be used anymore."
+        del self.frames, self.index, self.count
+        self.mm.flush()
+        self.mm.close()
+
+    def close(self):
+        "Flush the frames to disk and close the file."
+        self.release()
+        os.close(self.fd)
+
+
+class RawChunk:
+    """Read-only access to a raw chunk file, frames being views on the mapped file.
+
+    :param path: path of the chunk file
+    """
+
+    def __init__(self, path):
+        "Map the chunk file and read its header."
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a raw chunk file")
+        description = bytes(self.mm[JSON_OFFSET:HEADER_SIZE]).rstrip(b"\0")
+        self.metadata = json.loads(description)
+        self.n_frames = int(np.frombuffer(self.mm, dtype=np.uint64, count=1, offset=COUNT_OFFSET)[0])
+
+    @property
+    def index(self):
+        "Return the index table of the written frames."
+        return np.frombuffer(self.mm, dtype=INDEX_DTYPE, count=self.n_frames,
+                             offset=self.metadata["index_offset"])
+
+    @property
+    def frames(self):
+        "Return the frames as an array of shape (n_frames, height, width[, channels])."
+        m = self.metadata
+        data = np.frombuffer(self.mm, dtype=np.uint8, count=self.n_frames * m["frame_size"],
+                             offset=m["data_offset"])
+        stride = m["frame_size"] // m["height"]
+        frames = data.reshape(self.n_frames, m["height"], stride)
+        bpp = m.get("bpp", 1)
+        frames = frames[:, :, :m["width"] * bpp]
+        if bpp > 1:
+            frames = frames.reshape(self.n_frames, m["height"], m["width"], bpp)
+        return frames
+
+    def close(self):
+        "Unmap the file."
+        self.mm.close()
@@ -2,67 +2,142 @@
 import sys
 import signal
 import argparse
+import threading
 from shutil import copyfile
 from pathlib import Path
 
 from tiscam.helpers import clean_output_dir, get_logger
 from tiscam.camera import Camera
 from tiscam.config import Config, read_config
+from tiscam.metrics import MetricsServer
+from tiscam.diskwriter import spread_root
+from tiscam.arming import StartListener
+from tiscam.scheduling import scheduling_profile
 
 
-parser = argparse.ArgumentParser(__doc__)
-parser.add_argument("-c", "--config_path",
-                    help="Path to the state file of the camera",
-                    dest="config_path", default="configs.toml",
-                    type=lambda x: Path(x).expanduser().absolute())
-parser.add_argument("-s", "--serial",
-                    help="Serial of camera",
-                    dest="serial", default=False)
-parser.add_argument("-o", "--output-dir",
-                    help="Output directory where to save videos",
-                    dest="output_parent", default=False)
+def get_output_path(arguments, serial, output_parent=None, index=0):
+    "Return the output directory of the index-th camera, spread across the disk roots if they are set."
+    camera_prefix = arguments["path"]["prefix"]
+    roots = arguments.get("disk", {}).get("roots")
+    if not output_parent and roots:
+        output_parent = spread_root(roots, index)
+    output_parent = output_parent or arguments["path"]["output_folder"]
+    output_file =  f"{camera_prefix}_{serial}"
+    return Path(output_parent).expanduser().absolute() / output_file
 
-args = parser.parse_args()
-config_path = args.config_path
-serial = args.serial
 
-arguments = read_config(config_path)["tiscam"]
+def create_camera(config_path, serial, output_path, raw_config=None):
+    "Create the logger, configuration and Camera object recording a serial in output_path."
+    raw_config = raw_config if raw_config is not None else read_config(config_path)
+    arguments = raw_config["tiscam"]
 
-camera_prefix = arguments["path"]["prefix"]
-overwrite = arguments["path"]["overwrite"]
+    stream_log_level = arguments["logging"]["stream_level"]
+    gst_debug_level = arguments["logging"]["gst_level"]
+    file_log_level = arguments["logging"]["file_level"]
+    asynchronous_log = arguments["logging"].get("asynchronous", False)
+    log_interval = arguments["logging"].get("summary_interval", 1)
 
-stream_log_level = arguments["logging"]["stream_level"]
-gst_debug_level = arguments["logging"]["gst_level"]
-file_log_level = arguments["logging"]["file_level"]
+    compression_level = arguments["pipeline"]["compression_level"]
+    max_buffers_queue = arguments["pipeline"]["max_buffers_queue"]
+    persistent = arguments["pipeline"].get("persistent", False)
+    source_type = arguments["pipeline"].get("source", "tcambin")
+    encoder_name = arguments["pipeline"].get("encoder", "x264")
+    encoder_options = arguments["pipeline"].get(encoder_name, {})
+    capture_format = arguments["pipeline"].get("capture_format", "bgrx")
+    writer = arguments["pipeline"].get("writer", "mux")
+    backpressure = arguments.get("backpressure", {})
+    tracing = arguments["pipeline"].get("tracing", False)
+    tap = arguments.get("tap", {})
+    preview = arguments.get("preview", {})
+    disk = arguments.get("disk", {})
+    scheduling = scheduling_profile(arguments["pipeline"].get("scheduling", {}), serial)
 
-compression_level = arguments["pipeline"]["compression_level"]
-max_buffers_queue = arguments["pipeline"]["max_buffers_queue"]
+    logger = get_logger(f"cam_{serial}", stream_log_level, file_log_level, output_path / f"cam_{serial}.log",
+                        asynchronous=asynchronous_log)
 
-output_parent = args.output_parent or arguments["path"]["output_folder"]
-output_file =  f"{camera_prefix}_{serial}"
-output_path = Path(output_parent).expanduser().absolute() / output_file
+    config_copy_path = output_path / config_path.name
+    copyfile(config_path, config_copy_path)
 
-if not clean_output_dir(output_path, overwrite):
-    sys.exit()
-logger = get_logger(f"cam_{serial}", stream_log_level, file_log_level, output_path / f"cam_{serial}.log") 
+    config = Config(config_path, serial, raw_config=raw_config)
+    return Camera(config,
+                  logger=logger,
+                  path_to_output=output_path,
+                  gst_debug_level=gst_debug_level,
+                  compression_level=compression_level,
+                  max_buffers_queue=max_buffers_queue,
+                  persistent=persistent,
+                  source_type=source_type,
+                  log_interval=log_interval,
+                  encoder_name=encoder_name,
+                  encoder_options=encoder_options,
+                  capture_format=capture_format,
+                  writer=writer,
+                  backpressure=backpressure,
+                  tracing=tracing,
+                  tap=tap,
+                  preview=preview,
+                  disk=disk,
+                  scheduling=scheduling)
 
-config_copy_path = output_path / config_path.name
-copyfile(config_path, config_copy_path)
 
-def terminate(*args):
-    "Stop the capture and clean up."
-    global c
-    c.stop_capture()
-    sys.exit()
-signal.signal(signal.SIGINT, terminate)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("-c", "--config_path",
+                        help="Path to the state file of the camera",
+                        dest="config_path", default="configs.toml",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-s", "--serial",
+                        help="Serial of camera",
+                        dest="serial", default=False)
+    parser.add_argument("-o", "--output-dir",
+                        help="Output directory where to save videos",
+                        dest="output_parent", default=False)
+    parser.add_argument("--arm",
+                        help="Prepare the camera and wait for SIGUSR2 or the start command",
+                        dest="armed", action="store_true", default=None)
 
+    args = parser.parse_args()
+    config_path = args.config_path
+    serial = args.serial
 
-config = Config(config_path, serial)
-c = Camera(config,
-           logger=logger,
-           path_to_output=output_path,
-           gst_debug_level=gst_debug_level,
-           compression_level=compression_level,
-           max_buffers_queue=max_buffers_queue)
+    raw_config = read_config(config_path)
+    arguments = raw_config["tiscam"]
+    overwrite = arguments["path"]["overwrite"]
+    output_path = get_output_path(arguments, serial, args.output_parent)
+    start = arguments.get("start", {})
+    armed = args.armed if args.armed is not None else start.get("armed", False)
 
-c.start_capture()
+    if not clean_output_dir(output_path, overwrite, interactive=not armed):
+        sys.exit()
+
+    c = create_camera(config_path, serial, output_path, raw_config)
+
+    metrics_address = arguments.get("metrics", {}).get("address")
+    if metrics_address:
+        metrics_server = MetricsServer({serial: c}, metrics_address)
+        metrics_server.start()
+
+    def terminate(*args):
+        "Stop the capture and clean up."
+        if c.armed:
+            c.disarm()
+        else:
+            c.stop_capture()
+        sys.exit()
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGUSR1, lambda *args: c.toggle_preview())
+
+    if armed:
+        c.arm(start.get("preroll_timeout", 5))
+        started = threading.Event()
+        signal.signal(signal.SIGUSR2, lambda *args: started.set())
+        listener = None
+        if start.get("address"):
+            listener = StartListener(start["address"], lambda t: started.set())
+            listener.start()
+        c.logger.info("Waiting for SIGUSR2 or the start command")
+        started.wait()
+        if listener is not None:
+            listener.stop()
+
+    c.start_capture()
@@ -0,0 +1,244 @@
+"""
+Record several cameras from a single process.
+
+All the cameras share the GStreamer initialization, the parsed
+configuration and one GLib main loop handling signals and monitoring. Each
+camera records in its own thread and output directory, so the failure of a
+camera is logged and does not stop the others.
+
+When armed, every camera is prepared and prerolled at once, then they are
+all started with the same base time on SIGUSR2 or a "start" sent to the
+start address (see tiscam.arming).
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import GLib, Gst
+
+from tiscam.helpers import clean_output_dir
+from tiscam.config import read_config, get_serials
+from tiscam.record import get_output_path, create_camera
+from tiscam.metrics import MetricsServer
+from tiscam.arming import StartListener, first_frame_report
+
+
+class Recorder:
+    """Drive several cameras with one main loop.
+
+    :param config_path: path to the configuration file
+    :param serials: serials of the cameras to record
+    :param output_parent: directory where the camera directories are created
+    :param raw_config: already parsed configuration, read from config_path if None
+    :param check_interval: interval (in s) between two checks of the cameras
+    :param metrics_address: address of the metrics endpoint, [tiscam.metrics] address if None
+    :param armed: prepare the cameras and wait for the start command, [tiscam.start] armed if None
+    :param start_address: address receiving the start command, [tiscam.start] address if None
+    """
+
+    def __init__(self, config_path, serials, output_parent=None, raw_config=None, check_interval=1,
+                 metrics_address=None, armed=None, start_address=None):
+        "Parse the configuration once."
+        self.config_path = config_path
+        self.raw_config = raw_config if raw_config is not None else read_config(config_path)
+        self.serials = serials
+        self.output_parent = output_parent
+        self.check_interval = check_interval
+        self.cameras = {}
+        self.failed = {}
+        self.metrics_address = metrics_address or self.raw_config["tiscam"].get("metrics", {}).get("address")
+        self.metrics_server = None
+        start = self.raw_config["tiscam"].get("start", {})
+        self.armed = armed if armed is not None else start.get("armed", False)
+        self.start_address = start_address or start.get("address")
+        self.preroll_timeout = start.get("preroll_timeout", 5)
+        self.report_timeout = start.get("report_timeout", 10)
+        self.start_listener = None
+        self.started = False
+        self.loop = GLib.MainLoop()
+        gst_level = self.raw_config["tiscam"]["logging"]["gst_level"]
+        if not Gst.is_initialized():
+            Gst.init(["record_all.py", f"--gst-debug-level={gst_level}"])
+
+    def prepare(self):
+        "Create the output directory and the Camera object of each serial."
+        arguments = self.raw_config["tiscam"]
+        overwrite = arguments["path"]["overwrite"]
+        for index, serial in enumerate(self.serials):
+            output_path = get_output_path(arguments, serial, self.output_parent, index)
+            try:
+                if not clean_output_dir(output_path, overwrite, interactive=not self.armed):
+                    raise FileExistsError(f"{output_path} was not cleaned")
+                self.cameras[serial] = create_camera(self.config_path, serial, output_path,
+                                                     self.raw_config)
+            except Exception as error:
+                logging.error(f"Camera {serial} could not be created: {error}")
+                self.failed[serial] = error
+
+    def arm(self):
+        "Arm every camera at once, the cameras failing to arm being reported and released."
+        t = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(self.cameras)) as executor:
+            futures = {serial: executor.submit(camera.arm, self.preroll_timeout)
+                       for serial, camera in self.cameras.items()}
+        for serial, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Camera {serial} could not be armed: {error}")
+                self.failed[serial] = error
+                self.cameras.pop(serial).disarm()
+        logging.info(f"Armed {len(self.cameras)} cameras in {time.perf_counter() - t:.2f}s")
+
+    def start(self, command_time=None):
+        "Start every camera at once, with the same base time, and monitor them."
+        self.started = True
+        base_time = Gst.SystemClock.obtain().get_time()
+        for serial, camera in self.cameras.items():
+            camera.start(base_time)
+        if command_time is not None:
+            logging.info(f"Started {len(self.cameras)} cameras "
+                         f"{(time.time() - command_time) * 1e3:.1f}ms after the start command")
+        else:
+            logging.info(f"Started {len(self.cameras)} cameras")
+        GLib.timeout_add(int(self.check_interval * 1000), self.check_cameras)
+        GLib.timeout_add(100, self.report_first_frames, time.perf_counter())
+
+    def start_metrics(self):
+        "Start the metrics endpoint."
+        if self.metrics_address:
+            self.metrics_server = MetricsServer(self.cameras, self.metrics_address)
+            self.metrics_server.start()
+            logging.info(f"Serving metrics on {self.metrics_address}")
+
+    def report_first_frames(self, start):
+        "Report the time to the first frame of the cameras once they all have one, or after the report timeout."
+        waiting = any(camera.time_to_first_frame is None and camera.is_alive for camera in self.cameras.values())
+        if waiting and time.perf_counter() - start < self.report_timeout:
+            return True
+        for line in first_frame_report(self.cameras):
+            logging.info(line)
+        return False
+
+    def on_start(self, command_time=None):
+        "Start the armed cameras on SIGUSR2 or a start command."
+        if not self.started:
+            logging.info("Start command received")
+            self.start(command_time or time.time())
+        return False
+
+    def stop(self):
+        "Stop every camera, closing their last video, or release them if they were not started."
+        if self.start_listener is not None:
+            self.start_listener.stop()
+            self.start_listener = None
+        for camera in self.cameras.values():
+            camera.stop(wait=False)
+        for camera in self.cameras.values():
+            camera.stop()
+            if camera.thread is None:
+                camera.disarm()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.loop.is_running():
+            self.loop.quit()
+
+    def check_cameras(self):
+        "Report the cameras that stopped and quit when none is left."
+        for serial, camera in self.cameras.items():
+            if not camera.is_alive and serial not in self.failed:
+                self.failed[serial] = camera.error
+                logging.error(f"Camera {serial} stopped: {camera.error}")
+        if all(not camera.is_alive for camera in self.cameras.values()):
+            self.loop.quit()
+            return False
+        return True
+
+    def on_signal(self):
+        "Stop the recording on SIGINT/SIGTERM."
+        logging.warning("Stopped manually by user")
+        self.stop()
+        return False
+
+    def on_toggle_preview(self):
+        "Attach or detach the preview of every camera on SIGUSR1."
+        for camera in self.cameras.values():
+            camera.toggle_preview()
+        return True
+
+    def run(self):
+        "Prepare and start every camera, or arm them and wait for the start, then run the main loop until they all stop."
+        self.prepare()
+        if self.armed and self.cameras:
+            self.arm()
+        if not self.cameras:
+            logging.error("No camera to record")
+            return
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, self.on_signal)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.on_toggle_preview)
+        self.start_metrics()
+        if self.armed:
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGUSR2, self.on_start)
+            waiting = f"SIGUSR2 (pid {os.getpid()})"
+            if self.start_address:
+                self.start_listener = StartListener(self.start_address,
+                                                    lambda t: GLib.idle_add(self.on_start, t))
+                self.start_listener.start()
+                waiting += f" or start on {self.start_address}"
+            logging.info(f"Waiting for {waiting}")
+        else:
+            self.start()
+        try:
+            self.loop.run()
+        finally:
+            self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("-c", "--config_path",
+                        help="Path to the configuration file",
+                        dest="config_path", default="configs.toml",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-s", "--serials",
+                        help="Serials of the cameras (default: every connected camera)",
+                        dest="serials", nargs="+", default=None)
+    parser.add_argument("-o", "--output-dir",
+                        help="Output directory where to save videos",
+                        dest="output_parent", default=None)
+    parser.add_argument("--test",
+                        help="Record N videotestsrc sources instead of cameras",
+                        dest="n_test", default=0, type=int)
+    parser.add_argument("-m", "--metrics",
+                        help='Address of the metrics endpoint, "host:port" or "unix:/path"',
+                        dest="metrics_address", default=None)
+    parser.add_argument("--arm",
+                        help="Prepare every camera and wait for SIGUSR2 or the start command",
+                        dest="armed", action="store_true", default=None)
+    parser.add_argument("--start-address",
+                        help='Address receiving the start command, "host:port" or "unix:/path"',
+                        dest="start_address", default=None)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    raw_config = read_config(args.config_path)
+
+    if args.n_test > 0:
+        raw_config["tiscam"]["pipeline"]["source"] = "videotestsrc"
+        serials = [f"test{i}" for i in range(args.n_test)]
+    else:
+        serials = args.serials or get_serials()
+
+    recorder = Recorder(args.config_path, serials, args.output_parent, raw_config,
+                        metrics_address=args.metrics_address, armed=args.armed,
+                        start_address=args.start_address)
+    recorder.run()
+    sys.exit(1 if recorder.failed else 0)
@@ -0,0 +1,150 @@
+"""
+Placement of the streaming threads of a camera on the CPU cores.
+
+When enabled in [tiscam.pipeline.scheduling], the threads of the pipeline
+are placed as they start, from the stream-status messages posted by each
+streaming thread when it enters its loop:
+
+- capture: the thread of the source, which also runs the handoff callback
+  recording the timestamps, pinned to capture_cores, optionally with the
+  SCHED_FIFO priority capture_priority (1-99) or the niceness capture_nice;
+- encoder: the threads after the queue (encoder, muxer and writer), pinned
+  to encoder_cores with the default policy and the niceness encoder_nice.
+  The threads created by the encoder (x264 slices) inherit their placement.
+
+The keys of [tiscam.pipeline.scheduling] apply to every camera, and are
+overridden by the table of a serial, e.g.:
+
+    [tiscam.pipeline.scheduling.44120512]
+    capture_cores = [2]
+    encoder_cores = [3, 4, 5]
+
+Real-time priorities and negative niceness need CAP_SYS_NICE, or an rtprio
+and nice limit in /etc/security/limits.conf.
+"""
+import os
+import threading
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+POLICY_NAMES = {os.SCHED_OTHER: "other", os.SCHED_FIFO: "fifo", os.SCHED_RR: "rr",
+                os.SCHED_BATCH: "batch", os.SCHED_IDLE: "idle"}
+
+
+def scheduling_profile(scheduling, serial):
+    "Return the scheduling parameters of a camera, the table of its serial overriding the common keys."
+    profile = {key: value for key, value in scheduling.items() if not isinstance(value, dict)}
+    profile.update(scheduling.get(str(serial), {}))
+    return profile
+
+
+def thread_placement(tid):
+    "Return the cores, scheduling policy, real-time priority and niceness of a thread."
+    return {"cores": sorted(os.sched_getaffinity(tid)),
+            "policy": POLICY_NAMES.get(os.sched_getscheduler(tid), "unknown"),
+            "priority": os.sched_getparam(tid).sched_priority,
+            "nice": os.getpriority(os.PRIO_PROCESS, tid)}
+
+
+def format_cores(cores):
+    "Return a list of cores as ranges, e.g. 0-3,6."
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+class Scheduler:
+    """Place the capture and encoder threads of a camera when they start.
+
+    :param logger: logger of the camera
+    :param capture_cores: cores of the capture thread, every core if empty
+    :param encoder_cores: cores of the encoder threads, every core if empty
+    :param capture_priority: SCHED_FIFO priority of the capture thread, 0 to keep the default policy
+    :param capture_nice: niceness of the capture thread, None to keep it
+    :param encoder_nice: niceness of the encoder threads, None to keep it
+    :param encoder_threads: number of threads of the encoder, 0 to keep the encoder option
+    """
+
+    def __init__(self, logger, capture_cores=None, encoder_cores=None, capture_priority=0,
+                 capture_nice=None, encoder_nice=None, encoder_threads=0):
+        "Check the cores against the cores available to the process."
+        self.logger = logger
+        available = os.sched_getaffinity(0)
+        self.cores = {"capture": set(capture_cores or []), "encoder": set(encoder_cores or [])}
+        for group, cores in self.cores.items():
+            if not cores <= available:
+                raise ValueError(f"{group}_cores {format_cores(cores - available)} are not available, "
+                                 f"available cores: {format_cores(available)}")
+        if not 0 <= capture_priority <= 99:
+            raise ValueError(f"capture_priority {capture_priority} is not between 0 and 99")
+        self.capture_priority = capture_priority
+        self.nice = {"capture": capture_nice, "encoder": encoder_nice}
+        self.encoder_threads = encoder_threads
+        self.elements = {}
+        self.placement = {}
+        self.warned = set()
+        self.lock = threading.Lock()
+
+    def attach(self, pipeline, source, writers):
+        "Place the threads of a newly created pipeline, from its source and the elements after its queue."
+        self.elements = {"capture": [source], "encoder": [e for e in writers if e is not None]}
+        with self.lock:
+            self.placement.clear()
+        bus = pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect("sync-message::stream-status", self.on_stream_status)
+
+    def group(self, owner):
+        "Return the group of the thread of an element, None for the other branches (tap, preview)."
+        for group, elements in self.elements.items():
+            # The threads of a bin (tcambin, splitmuxsink) are owned by its children
+            if any(owner == element or owner.has_as_ancestor(element) for element in elements):
+                return group
+        return None
+
+    def on_stream_status(self, bus, message):
+        "Place the streaming thread posting the message, when it enters its loop."
+        status, owner = message.parse_stream_status()
+        if status != Gst.StreamStatusType.ENTER:
+            return
+        group = self.group(owner)
+        if group is None:
+            return
+        tid = threading.get_native_id()
+        self.place(group)
+        placement = thread_placement(tid)
+        with self.lock:
+            self.placement[tid] = {"name": owner.get_name(), "group": group, **placement}
+        self.logger.info(f"{group.capitalize()} thread {tid} ({owner.get_name()}): "
+                         f"cores {format_cores(placement['cores'])}, {placement['policy']} "
+                         f"priority {placement['priority']}, nice {placement['nice']}")
+
+    def place(self, group):
+        "Apply the placement of a group to the calling thread."
+        tid = threading.get_native_id()
+        try:
+            if self.cores[group]:
+                os.sched_setaffinity(0, self.cores[group])
+            if group == "capture" and self.capture_priority > 0:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.capture_priority))
+            elif group == "encoder":
+                # The task pool reuses the threads, one may have been a real-time capture thread
+                os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            if self.nice[group] is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, self.nice[group])
+        except PermissionError as error:
+            if group not in self.warned:
+                self.warned.add(group)
+                self.logger.warning(f"The {group} thread could not be placed ({error}), "
+                                    "real-time priorities and negative niceness need CAP_SYS_NICE")
+
+    def summary(self):
+        "Return the placement of the threads placed in the current pipeline."
+        with self.lock:
+            return dict(self.placement)
@@ -0,0 +1,94 @@
+"""
+Segmentation of the triggered frames in chunks of pwm.chunk_size frames.
+
+A chunk is complete as soon as the frame at its last expected position
+arrives. When the last frames of a chunk are lost, it is closed after a
+silence of timeout_delay, never before the expected end of the burst, so a
+late frame inside a burst does not split it.
+
+With the hardware frame counter of the camera (tcam statistics), the
+position of a frame is given by the number of triggers since the first
+frame of the session, so lost frames are located exactly and the frame
+indices leave holes at their place. Without it, frames are counted as they
+arrive.
+
+Frames arriving after the last expected position, before the chunk is
+closed (extra triggers, next burst starting early), are counted as overflow:
+their indices continue past the end of the chunk, so they keep distinct
+trigger indices, and they are not counted in the chunk to estimate its loss.
+"""
+
+
+class ChunkSegmenter:
+    """Assign the frames of a triggered recording to chunks.
+
+    :param expected_frames: number of frames per chunk, pwm.chunk_size
+    :param period: expected interval (in s) between two frames, 1/pwm.frequency
+    :param timeout_delay: silence (in s) closing a chunk whose last frames are missing
+    """
+
+    def __init__(self, expected_frames, period, timeout_delay):
+        "Start the first chunk."
+        self.expected_frames = expected_frames
+        self.period = period
+        self.timeout_delay = timeout_delay
+        self.chunk = 0
+        self.count_offset = None  # Hardware count of the first frame of the session
+        self.resyncs = 0
+        self.next_chunk(first=True)
+
+    def next_chunk(self, first=False):
+        "Start the next chunk."
+        if not first:
+            self.chunk += 1
+        self.received = 0
+        self.overflow = 0
+        self.last_position = -1
+        self.chunk_start = None
+        self.complete = False
+
+    @property
+    def first_frame(self):
+        "Return the index of the first frame of the current chunk."
+        return self.chunk * self.expected_frames
+
+    def position(self, frame_count):
+        "Return the position of a frame in the current chunk."
+        if frame_count < 0:
+            return self.received + self.overflow
+        if self.count_offset is None:
+            self.count_offset = frame_count - self.first_frame - self.received
+        chunk, position = divmod(frame_count - self.count_offset, self.expected_frames)
+        if self.complete and chunk == self.chunk + 1:
+            return self.expected_frames + position
+        if chunk != self.chunk or position <= self.last_position:
+            # The counter disagrees with the chunks (reset, chunk split by a timeout...)
+            self.resyncs += 1
+            position = self.last_position + 1 + self.overflow
+            self.count_offset = frame_count - self.first_frame - position
+        return position
+
+    def add(self, t, frame_count=-1):
+        "Register a frame received at time t, return its index in the session."
+        position = self.position(frame_count)
+        if position >= self.expected_frames:
+            self.overflow += 1
+            return self.first_frame + position
+        if self.chunk_start is None:
+            self.chunk_start = t - position * self.period
+        self.received += 1
+        self.last_position = position
+        self.complete = position == self.expected_frames - 1
+        return self.first_frame + position
+
+    def deadline(self, time_of_last_frame):
+        "Return the time at which the current chunk is closed if its last frames are missing."
+        expected_end = time_of_last_frame
+        if self.chunk_start is not None:
+            expected_end = max(expected_end, self.chunk_start + (self.expected_frames - 1) * self.period)
+        return expected_end + self.timeout_delay
+
+    @property
+    def loss(self):
+        "Return the number of frames missing from the current chunk."
+        return max(self.expected_frames - self.received, 0)
@@ -0,0 +1,165 @@
+"""
+Analyze all the cameras of a session in parallel, caching per-chunk summaries.
+
+The summary of each chunk is stored in a cache file in its camera
+directory, keyed by the mtime and size (and inode) of the record files. As
+these files are append-only, running the analysis again after new chunks
+were recorded only processes the new chunks.
+"""
+import os
+import json
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from tiscam.analysis import CameraTimestamps
+from tiscam.timestamps import read_chunks, FRAMES_FILE, CHUNKS_FILE
+
+CACHE_FILE = "analysis_cache.json"
+JITTER_PERCENTILES = [50, 95, 99]
+
+
+def summarize_chunks(camera_dir, chunk_ids, period=None, pause=0):
+    "Return the summary statistics of some chunks of a camera."
+    cam = CameraTimestamps(camera_dir, period=period, pause=pause, chunk_ids=chunk_ids)
+    summaries = []
+    for i, chunk in enumerate(cam.chunks):
+        jitter = np.abs(cam.deviation[cam.chunk_slice(i)][1:])
+        percentiles = (np.percentile(jitter, JITTER_PERCENTILES) if len(jitter)
+                       else np.full(len(JITTER_PERCENTILES), np.nan))
+        summaries.append({
+            "chunk": int(chunk["chunk"]),
+            "first_frame": int(chunk["first_frame"]),
+            "n_frames": int(chunk["n_frames"]),
+            "loss": int(chunk["loss"]),
+            "dropped": int(cam.chunk_dropped[i]),
+            "t0": float(cam.t0[i]),
+            "tn": float(cam.tn[i]),
+            "excess_duration": float(cam.excess_duration[i]),
+            "jitter": {str(p): float(v) for p, v in zip(JITTER_PERCENTILES, percentiles)}})
+    return summaries
+
+
+def file_keys(camera_dir):
+    "Return the (mtime, size, inode) of the record files of a camera directory."
+    keys = {}
+    for name in [FRAMES_FILE, CHUNKS_FILE]:
+        stat = (Path(camera_dir) / name).stat()
+        keys[name] = [stat.st_mtime, stat.st_size, stat.st_ino]
+    return keys
+
+
+def read_cache(camera_dir, params):
+    "Return the cached summaries still valid for the current record files."
+    path = Path(camera_dir) / CACHE_FILE
+    if not path.exists():
+        return {}
+    with path.open("r") as f:
+        cache = json.load(f)
+    if cache.get("params") != params:
+        return {}
+    for name, (mtime, size, inode) in file_keys(camera_dir).items():
+        cached_mtime, cached_size, cached_inode = cache["files"].get(name, [np.inf, np.inf, None])
+        # Record files only grow, anything else means they were rewritten
+        if size < cached_size or mtime < cached_mtime or inode != cached_inode:
+            return {}
+    return {int(k): v for k, v in cache["chunks"].items()}
+
+
+def write_cache(camera_dir, params, keys, summaries):
+    "Atomically replace the cache file of a camera directory."
+    path = Path(camera_dir) / CACHE_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("w") as f:
+        json.dump({"params": params, "files": keys,
+                   "chunks": {str(k): v for k, v in summaries.items()}}, f)
+    tmp_path.replace(path)
+
+
+def split(chunk_ids, n_groups):
+    "Split chunk ids in at most n_groups contiguous groups."
+    return [list(map(int, g)) for g in np.array_split(chunk_ids, n_groups) if len(g)]
+
+
+def add_pause_excess(summaries, pause):
+    "Add the excess of the pause preceding each chunk, in place."
+    last_tn = None
+    for s in summaries:
+        s["pause_excess"] = None if last_tn is None else s["t0"] - last_tn - pause
+        last_tn = s["tn"]
+    return summaries
+
+
+def analyze_session(path, prefix="cam", period=None, pause=0, workers=None, groups_per_camera=None):
+    """Return the chunk summaries of every camera of a session, by camera name.
+
+    Chunks missing from the cache are split in groups for each camera and
+    analyzed by a pool of processes.
+    """
+    cameras = [c for c in sorted(Path(path).glob(f"{prefix}*")) if (c / CHUNKS_FILE).exists()]
+    params = {"period": period, "pause": pause}
+    workers = workers or os.cpu_count()
+    groups_per_camera = groups_per_camera or max(1, workers // max(len(cameras), 1))
+
+    cached, keys, futures = {}, {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for cam in cameras:
+            keys[cam] = file_keys(cam)
+            cached[cam] = read_cache(cam, params)
+            chunk_ids = read_chunks(cam)["chunk"]
+            new_ids = np.setdiff1d(chunk_ids, list(cached[cam]))
+            futures[cam] = [pool.submit(summarize_chunks, cam, ids, period, pause)
+                            for ids in split(new_ids, groups_per_camera)]
+
+        results = {}
+        for cam in cameras:
+            summaries = dict(cached[cam])
+            for future in futures[cam]:
+                summaries.update({s["chunk"]: s for s in future.result()})
+            if futures[cam]:
+                write_cache(cam, params, keys[cam], summaries)
+            ordered = [summaries[k] for k in sorted(summaries)]
+            results[cam.name] = add_pause_excess(ordered, pause)
+    return results
+
+
+def print_summary(results):
+    "Print one line per camera and per chunk with losses and jitter."
+    for name, summaries in results.items():
+        loss = sum(s["loss"] for s in summaries)
+        dropped = sum(s["dropped"] for s in summaries)
+        print(f"{name}: {len(summaries)} chunks - loss {loss} - dropped {dropped}")
+        for s in summaries:
+            pause_excess = "" if s["pause_excess"] is None else f" - pause excess {s['pause_excess'] * 1e3:.1f}ms"
+            jitter = " ".join(f"p{p}={v * 1e3:.3f}ms" for p, v in s["jitter"].items())
+            print(f"    {s['first_frame']:06d}: {s['n_frames']} frames - loss {s['loss']} - "
+                  f"excess {s['excess_duration'] * 1e3:.1f}ms{pause_excess} - jitter {jitter}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from tiscam.config import read_config
+    from tiscam.analysis import expected_timing
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("-p", "--path",
+                        help="Path to the directory containg the cameras",
+                        dest="path", default="~/data",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-c", "--config",
+                        help="Path to the configuration file, to get the expected period and pause",
+                        dest="config_path", default=None,
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("--cam-prefix",
+                        help="Prefix of directories for each cam (ex. [cam]1, [cam]2)",
+                        dest="prefix", default="cam")
+    parser.add_argument("-j", "--workers",
+                        help="Number of worker processes (default: number of cores)",
+                        dest="workers", default=None, type=int)
+    args = parser.parse_args()
+
+    period, pause = None, 0
+    if args.config_path is not None:
+        period, pause = expected_timing(read_config(args.config_path))
+
+    print_summary(analyze_session(args.path, args.prefix, period, pause, args.workers))
@@ -0,0 +1,237 @@
+"""
+Source backends of the recording pipeline.
+
+The source is selected with `source` in [tiscam.pipeline]:
+
+    tcambin       The Imaging Source camera (default)
+    videotestsrc  free-running test pattern
+    appsrc        synthetic camera emulating the PWM trigger: bursts of
+                  pwm.chunk_size frames at pwm.frequency Hz separated by
+                  pwm.chunk_pause ms, or a continuous stream at the caps
+                  framerate when "Trigger Mode" is false
+
+The synthetic sources accept the camera properties through a shim, so the
+configuration of a real camera can be used as is without tiscamera.
+"""
+import time
+import threading
+import numpy as np
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import GObject, Gst
+
+try:
+    gi.require_version("Tcam", "0.1")
+    from gi.repository import Tcam
+except (ValueError, ImportError):
+    Tcam = None  # tiscamera is not installed, only the synthetic sources work
+
+from tiscam.rawwriter import BYTES_PER_PIXEL
+from tiscam.config import value_type
+
+# Frames the synthetic camera can hold while the pipeline is blocked
+SOURCE_BUFFERS = 4
+
+
+class TcamSource:
+    """The Imaging Source camera, through tcambin.
+
+    :param config: Config object of the camera
+    :param logger: logger of the camera
+    """
+
+    def __init__(self, config, logger):
+        "Store the configuration."
+        self.config = config
+        self.logger = logger
+        self.element = None
+
+    def description(self):
+        "Return the pipeline description of the source, named source."
+        return "tcambin name=source"
+
+    def attach(self, element, caps):
+        "Select the camera of the newly created source element."
+        self.element = element
+        element.set_property("serial", self.config.caps["serial"])
+        self.logger.debug(f"Serial: {self.config.caps['serial']}")
+
+    def start(self):
+        "Nothing to do, the camera streams once the pipeline is playing."
+
+    def stop(self):
+        "Nothing to do, the camera stops with the pipeline."
+
+    def describe(self, property_name):
+        "Return the type, range and menu entries of a property, None if the camera does not have it."
+        prop = self.element.get_tcam_property(property_name)
+        if not prop[0]:
+            return None
+        info = {"type": prop.type, "min": None, "max": None, "entries": None}
+        if prop.type in ["integer", "double"]:
+            info["min"], info["max"] = prop.min, prop.max
+        if prop.type == "enum":
+            info["entries"] = list(self.element.get_tcam_menu_entries(property_name))
+        return info
+
+    def get_property(self, property_name):
+        "Return the current value of a property."
+        return self.element.get_tcam_property(property_name).value
+
+    def set_property(self, property_name, value):
+        "Set a property, its value having the type given by the property plan"
+        self.logger.debug(f"Setting property {property_name} at {value}")
+        result = self.element.set_tcam_property(property_name, GObject.Value(type(value), value))
+        if result is False:
+            self.logger.warning(f"Failed to set {property_name} to value {value}")
+
+
+class PropertyShim:
+    """Base of the synthetic sources, storing the camera properties.
+
+    Only "Trigger Mode" changes the behaviour of the source, the other
+    properties are kept in `properties` so they can be read back.
+
+    :param config: Config object of the camera
+    :param logger: logger of the camera
+    """
+
+    def __init__(self, config, logger):
+        "Start from the properties of the configuration."
+        self.config = config
+        self.logger = logger
+        self.element = None
+        self.properties = dict(config.properties)
+
+    def attach(self, element, caps):
+        "Store the newly created source element."
+        self.element = element
+
+    def start(self):
+        "Nothing to do by default."
+
+    def stop(self):
+        "Nothing to do by default."
+
+    def set_property(self, property_name, value):
+        "Store a property value."
+        self.logger.debug(f"Setting emulated property {property_name} at {value}")
+        self.properties[property_name] = value
+
+    def get_property(self, property_name):
+        "Return a stored property value."
+        return self.properties[property_name]
+
+    def describe(self, property_name):
+        "Return the type of a stored property, without range."
+        if property_name not in self.properties:
+            return None
+        return {"type": value_type(self.properties[property_name])}
+
+    @property
+    def triggered(self):
+        "Return True if the frames are triggered by the PWM."
+        value = self.properties.get("Trigger Mode", False)
+        return value in [True, "True", "true"]
+
+
+class TestSource(PropertyShim):
+    "Free-running videotestsrc, Bayer frames being emulated with rgb2bayer."
+
+    def description(self):
+        "Return the pipeline description of the source, named source."
+        p = "videotestsrc name=source is-live=true"
+        if self.config.caps["color"]:
+            p += " ! rgb2bayer"
+        return p
+
+
+class PwmSource(PropertyShim):
+    """Synthetic camera pushing frames from an appsrc at the timing of the PWM.
+
+    Frames are dropped, as by a camera, when the pipeline does not accept
+    them fast enough.
+    """
+
+    def __init__(self, config, logger):
+        "Read the PWM timing."
+        super().__init__(config, logger)
+        self.frequency = config.pwm["frequency"]
+        self.chunk_size = config.pwm["chunk_size"]
+        self.chunk_pause = config.pwm["chunk_pause"] / 1000
+        self.framerate = config.caps.get("framerate", self.frequency)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.pushed = 0
+        self.dropped = 0
+
+    def description(self):
+        "Return the pipeline description of the source, named source."
+        return "appsrc name=source is-live=true do-timestamp=true format=time block=false"
+
+    def attach(self, element, caps):
+        "Set the caps of the emulated camera and create a frame of the right size."
+        self.element = element
+        structure = caps.get_structure(0)
+        frame_size = (structure.get_value("width") * structure.get_value("height")
+                      * BYTES_PER_PIXEL.get(structure.get_string("format"), 1))
+        element.set_property("caps", caps)
+        element.set_property("max-bytes", SOURCE_BUFFERS * frame_size)
+        self.frame = np.random.default_rng().integers(0, 256, frame_size, dtype=np.uint8).tobytes()
+
+    def start(self):
+        "Start pushing frames, once the pipeline is playing."
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name=f"{self.logger.name}-pwm", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "Stop pushing frames."
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        "Push bursts of frames separated by pauses, or a continuous stream without trigger."
+        while not self.stopped.is_set():
+            triggered = self.triggered
+            period = 1 / (self.frequency if triggered else self.framerate)
+            n_frames = self.chunk_size if triggered else np.inf
+            start = time.perf_counter()
+            i = 0
+            while i < n_frames:
+                delay = start + i * period - time.perf_counter()
+                if self.stopped.wait(max(delay, 0)):
+                    return
+                if not self.push():
+                    return
+                i += 1
+            self.stopped.wait(self.chunk_pause)
+
+    def push(self):
+        "Push a frame, or drop it if the source is full, return False once the pipeline stopped."
+        if self.element.get_property("current-level-bytes") >= self.element.get_property("max-bytes"):
+            self.dropped += 1
+            return True
+        result = self.element.emit("push-buffer", Gst.Buffer.new_wrapped(self.frame))
+        if result == Gst.FlowReturn.OK:
+            self.pushed += 1
+            return True
+        if result == Gst.FlowReturn.FLUSHING:
+            return True
+        self.logger.warning(f"Synthetic source stopped: {result.value_nick}")
+        return False
+
+
+SOURCES = {"tcambin": TcamSource,
+           "videotestsrc": TestSource,
+           "appsrc": PwmSource}
+
+
+def create_source(name, config, logger):
+    "Return the source backend of a camera."
+    if name not in SOURCES:
+        raise ValueError(f"Unknown source {name}, available: {', '.join(SOURCES)}")
+    return SOURCES[name](config, logger)
@@ -0,0 +1,203 @@
+"""
+Live frames for online processing, alongside the recording.
+
+When the tap is enabled in [tiscam.tap], a tee after the first capsfilter
+of the pipeline feeds a leaky queue and an appsink, so the frames reach
+the consumer without waiting for their conversion and a slow consumer
+only loses tap frames, never recorded ones. A thread pulls the samples
+and calls the consumer with batches of Frame objects, at most max_rate
+batches per second, the frames in between being dropped.
+
+The array of a Frame is a NumPy view on the mapped buffer memory, without
+copy. It is only valid during the call of the consumer, which must copy
+what it keeps:
+
+    def consumer(frames):
+        for frame in frames:
+            positions.append(track(frame.array))
+
+    camera.tap.connect(consumer)
+
+The consumer can also be given as "module:function" with `consumer` in
+[tiscam.tap].
+"""
+import time
+import threading
+import importlib
+import collections
+import numpy as np
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from tiscam.rawwriter import BYTES_PER_PIXEL
+from tiscam.preview import TEE_NAME
+
+# Frames of the tap branch held while the consumer is busy
+TAP_BUFFERS = 2
+# Handoff times kept to match the tap frames with their index
+PENDING_FRAMES = 256
+
+
+class Frame:
+    """A frame delivered by the tap.
+
+    :param array: view on the mapped buffer, (height, width) or (height, width, channels)
+    :param index: frame index given by the recorder, -1 if unknown
+    :param pts: buffer presentation timestamp (ns)
+    :param handoff: wall time at which the recorder received the frame, nan if unknown
+    """
+
+    def __init__(self, array, index, pts, handoff):
+        "Store the view and the metadata of the frame."
+        self.array = array
+        self.index = index
+        self.pts = pts
+        self.handoff = handoff
+
+
+def resolve_consumer(path):
+    "Return the function named by a 'module:function' path."
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def frame_shape(caps):
+    "Return the height, width and channels of the frames of caps, and the NumPy dtype of their pixels."
+    structure = caps.get_structure(0)
+    fmt = structure.get_string("format")
+    if structure.get_name() == "video/x-bayer":
+        fmt = "GRAY8"
+    channels = BYTES_PER_PIXEL.get(fmt, 1)
+    dtype = np.uint16 if fmt == "GRAY16_LE" else np.uint8
+    if dtype == np.uint16:
+        channels = 1
+    return structure.get_value("height"), structure.get_value("width"), channels, dtype
+
+
+class FrameTap:
+    """Deliver live frames to a consumer from a leaky branch of the pipeline.
+
+    :param logger: logger of the camera
+    :param batch_size: number of frames given to each call of the consumer
+    :param batch_timeout: longest wait (in s) to fill a batch, a partial batch being delivered after it
+    :param max_rate: maximum number of batches per second, 0 for no limit
+    :param max_buffers: number of frames the tap branch holds while the consumer is busy
+    :param consumer: "module:function" of the consumer, or None to connect it later
+    """
+
+    def __init__(self, logger, batch_size=1, batch_timeout=0.1, max_rate=0, max_buffers=TAP_BUFFERS,
+                 consumer=None):
+        "Create the tap, attached to a pipeline by attach."
+        self.logger = logger
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.max_rate = max_rate
+        self.max_buffers = max_buffers
+        self.consumer = resolve_consumer(consumer) if consumer else None
+        self.appsink = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last_delivery = 0
+        self.delivered = 0
+        self.rate_limited = 0
+
+    def connect(self, consumer):
+        "Set the function called with each batch of frames."
+        self.consumer = consumer
+
+    def description(self):
+        "Return the description of the tap branch, from the tee of the pipeline."
+        return (f"{TEE_NAME}. ! queue name=tapqueue leaky=downstream max-size-buffers={self.max_buffers}"
+                " max-size-bytes=0 max-size-time=0"
+                f" ! appsink name=tapsink sync=false drop=true max-buffers={self.max_buffers}")
+
+    def attach(self, pipeline):
+        "Store the appsink of a newly created pipeline."
+        self.appsink = pipeline.get_by_name("tapsink")
+
+    def register(self, pts, index, handoff):
+        "Store the index and handoff time of a frame received by the recorder."
+        with self.lock:
+            self.pending[pts] = (index, handoff)
+            if len(self.pending) > PENDING_FRAMES:
+                self.pending.popitem(last=False)
+
+    def start(self):
+        "Start delivering frames, once the pipeline is playing."
+        if self.consumer is None:
+            self.logger.warning("The frame tap has no consumer, its frames are dropped")
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name=f"{self.logger.name}-tap", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "Stop delivering frames."
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def pull(self, timeout):
+        "Return the next sample of the appsink, None after timeout (in s)."
+        return self.appsink.emit("try-pull-sample", int(timeout * Gst.SECOND))
+
+    def run(self):
+        "Pull samples, group them in batches and deliver them, respecting the maximum rate."
+        while not self.stopped.is_set():
+            sample = self.pull(self.batch_timeout)
+            if sample is None:
+                continue
+            if self.consumer is None or self.is_rate_limited():
+                self.rate_limited += 1
+                continue
+            samples = [sample]
+            deadline = time.perf_counter() + self.batch_timeout
+            while len(samples) < self.batch_size and not self.stopped.is_set():
+                remaining = deadline - time.perf_counter()
+                sample = self.pull(remaining) if remaining > 0 else None
+                if sample is None:
+                    break
+                samples.append(sample)
+            self.deliver(samples)
+
+    def is_rate_limited(self):
+        "Return True if the last batch was delivered too recently."
+        return self.max_rate > 0 and time.perf_counter() - self.last_delivery < 1 / self.max_rate
+
+    def deliver(self, samples):
+        "Map the buffers of the samples, call the consumer with their frames and unmap them."
+        mapped, frames = [], []
+        try:
+            for sample in samples:
+                buffer = sample.get_buffer()
+                ok, info = buffer.map(Gst.MapFlags.READ)
+                if not ok:
+                    self.logger.error("Could not map a tap buffer")
+                    continue
+                mapped.append((buffer, info))
+                frames.append(self.frame(sample, buffer, info))
+            self.last_delivery = time.perf_counter()
+            self.consumer(frames)
+            self.delivered += len(frames)
+        except Exception as error:
+            self.logger.exception(f"Frame tap consumer failed: {error}")
+        finally:
+            for buffer, info in mapped:
+                buffer.unmap(info)
+
+    def frame(self, sample, buffer, info):
+        "Return the Frame viewing a mapped buffer."
+        height, width, channels, dtype = frame_shape(sample.get_caps())
+        itemsize = np.dtype(dtype).itemsize
+        stride = buffer.get_size() // height  # Rows can be padded
+        data = np.frombuffer(info.data, dtype=np.uint8)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        strides = (stride, channels * itemsize) if channels == 1 else (stride, channels * itemsize, itemsize)
+        array = np.ndarray(shape, dtype=dtype, buffer=data, strides=strides)
+        with self.lock:
+            index, handoff = self.pending.pop(buffer.pts, (-1, np.nan))
+        return Frame(array, index, buffer.pts, handoff)
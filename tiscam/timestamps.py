@@ -0,0 +1,309 @@
+"""
+Storage of the frame timestamps, in memory and on disk.
+
+On disk, each camera directory holds two append-only record files: one
+row per frame (FRAMES_FILE) and one row per chunk (CHUNKS_FILE). A file
+starts with a header giving the record dtype, followed by fixed-size
+records, so it can be memory-mapped and a partially written last record
+left by a crash is simply ignored.
+"""
+import os
+import json
+import pickle
+import threading
+import numpy as np
+from pathlib import Path
+
+CLOCK_TIME_NONE = np.iinfo(np.uint64).max  # Same value as Gst.CLOCK_TIME_NONE
+
+FRAMES_FILE = "frames.tsr"
+CHUNKS_FILE = "chunks.tsr"
+MAGIC = b"TISCAMTS"
+VERSION = 1
+HEADER_ALIGNMENT = 64
+
+FRAME_DTYPE = np.dtype([("chunk", np.int64),
+                        ("frame", np.int64),
+                        ("wall", np.float64),
+                        ("pts", np.uint64),
+                        ("dts", np.uint64),
+                        ("running_time", np.int64),
+                        ("camera_time", np.int64),
+                        ("frame_count", np.int64)])
+
+CHUNK_DTYPE = np.dtype([("chunk", np.int64),
+                        ("first_frame", np.int64),
+                        ("n_frames", np.int64),
+                        ("expected_frames", np.int64),
+                        ("loss", np.int64),
+                        ("framerate", np.float64),
+                        ("wall", np.float64),
+                        ("clock_time", np.int64),
+                        ("base_time", np.int64),
+                        ("wall_minus_running", np.float64),
+                        ("camera_minus_pts", np.float64)])
+
+
+class TimestampBuffer:
+    """Fixed-size array of frame timestamps, filled from the streaming thread.
+
+    Appends hold a lock while they claim a slot, write it and update the
+    length, so concurrent appends never overwrite each other, the array is
+    only reallocated if a video has more frames than the capacity.
+
+    :param capacity: number of frames to preallocate, usually pwm.chunk_size
+    """
+
+    def __init__(self, capacity, default_capacity=4096):
+        "Allocate the array."
+        self.capacity = capacity if capacity > 0 else default_capacity
+        self.data = np.zeros(self.capacity, dtype=FRAME_DTYPE)
+        self.length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        "Return the number of frames appended since the last clear."
+        return self.length
+
+    def append(self, frame, wall, pts=CLOCK_TIME_NONE, dts=CLOCK_TIME_NONE,
+               running_time=-1, camera_time=-1, frame_count=-1):
+        "Write the timestamps of a frame in the next free slot and return its index."
+        with self._lock:
+            i = self.length
+            if i >= len(self.data):
+                self._grow(i)
+            self.data[i] = (-1, frame, wall, pts, dts, running_time, camera_time, frame_count)
+            self.length = i + 1
+        return i
+
+    def _grow(self, index):
+        "Double the size of the array until index fits in it, called with the lock held."
+        size = len(self.data)
+        while size <= index:
+            size *= 2
+        data = np.zeros(size, dtype=FRAME_DTYPE)
+        data[:len(self.data)] = self.data
+        self.data = data
+
+    def view(self):
+        "Return the frames written since the last clear, without copy."
+        return self.data[:self.length]
+
+    def clear(self):
+        "Forget all the frames, keeping the allocated memory."
+        with self._lock:
+            self.data[:self.length] = 0
+            self.length = 0
+
+    def estimate_framerate(self):
+        "Return the mean framerate of the stored frames, None with less than 2 frames."
+        wall = self.view()["wall"]
+        if len(wall) < 2:
+            return None
+        duration = wall.max() - wall.min()
+        return float(len(wall) / duration) if duration > 0 else None
+
+    def clock_offsets(self):
+        "Return the median difference between the camera clock and the PTS (ns)."
+        frames = self.view()
+        valid = (frames["camera_time"] >= 0) & (frames["pts"] != CLOCK_TIME_NONE)
+        if not valid.any():
+            return None
+        offsets = frames["camera_time"][valid] - frames["pts"][valid].astype(np.int64)
+        return float(np.median(offsets))
+
+
+class RecordFile:
+    """Append-only file of fixed-size records.
+
+    :param path: path of the file, created with its header if missing
+    :param dtype: NumPy dtype of the records
+    """
+
+    def __init__(self, path, dtype):
+        "Open the file for appending, writing the header first if needed."
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            write_header(self.path, self.dtype)
+        else:
+            header_dtype, _ = read_header(self.path)
+            if header_dtype != self.dtype:
+                raise ValueError(f"{self.path} holds records of another type")
+        self.handle = self.path.open("ab")
+        self.truncate_partial_record()
+
+    def truncate_partial_record(self):
+        "Remove the end of a record interrupted by a crash, if any."
+        _, offset = read_header(self.path)
+        size = self.path.stat().st_size
+        extra = (size - offset) % self.dtype.itemsize
+        if extra:
+            self.handle.truncate(size - extra)
+
+    def append(self, records):
+        "Write records at the end of the file and flush them to disk."
+        records = np.ascontiguousarray(records, dtype=self.dtype)
+        self.handle.write(records.tobytes())
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        "Close the file."
+        self.handle.close()
+
+
+def write_header(path, dtype):
+    "Create a record file containing only its header."
+    description = json.dumps({"version": VERSION, "descr": dtype.descr}).encode()
+    length = len(MAGIC) + 4 + len(description)
+    padding = -length % HEADER_ALIGNMENT
+    header = MAGIC + np.uint32(length + padding).tobytes() + description + b" " * padding
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(header)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.replace(path)
+
+
+def read_header(path):
+    "Return the record dtype of a record file and the offset of its first record."
+    with Path(path).open("rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a timestamp record file")
+        offset = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        description = json.loads(f.read(offset - len(MAGIC) - 4))
+    descr = [tuple(field) for field in description["descr"]]
+    return np.dtype(descr), offset
+
+
+def read_records(path):
+    "Memory-map the complete records of a record file."
+    dtype, offset = read_header(path)
+    n_records = (Path(path).stat().st_size - offset) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(n_records,))
+
+
+def read_frames(camera_dir):
+    "Memory-map the frame timestamps of a camera directory."
+    return read_records(Path(camera_dir) / FRAMES_FILE)
+
+
+def read_chunks(camera_dir):
+    "Memory-map the chunk summaries of a camera directory."
+    return read_records(Path(camera_dir) / CHUNKS_FILE)
+
+
+def iter_chunks(camera_dir):
+    "Yield each chunk record of a camera directory with a view on its frames."
+    if not (Path(camera_dir) / CHUNKS_FILE).exists():
+        return
+    frames = read_frames(camera_dir)
+    chunks = read_chunks(camera_dir)
+    bounds = np.searchsorted(frames["chunk"], chunks["chunk"], side="left")
+    ends = np.searchsorted(frames["chunk"], chunks["chunk"], side="right")
+    for chunk, start, end in zip(chunks, bounds, ends):
+        yield chunk, frames[start:end]
+
+
+class TimestampWriter:
+    "Append the frames and the summary of each chunk to the record files of a directory."
+
+    def __init__(self, camera_dir):
+        "Open both record files."
+        self.frames = RecordFile(Path(camera_dir) / FRAMES_FILE, FRAME_DTYPE)
+        self.chunks = RecordFile(Path(camera_dir) / CHUNKS_FILE, CHUNK_DTYPE)
+
+    def write_chunk(self, chunk_id, frames, expected_frames, loss, framerate, clocks):
+        "Write the frames of a chunk, then its summary, which marks it as complete."
+        frames = np.array(frames, dtype=FRAME_DTYPE)
+        frames["chunk"] = chunk_id
+        self.frames.append(frames)
+
+        summary = np.zeros(1, dtype=CHUNK_DTYPE)
+        summary["chunk"] = chunk_id
+        summary["first_frame"] = frames["frame"][0] if len(frames) else -1
+        summary["n_frames"] = len(frames)
+        summary["expected_frames"] = expected_frames
+        summary["loss"] = loss
+        summary["framerate"] = np.nan if framerate is None else framerate
+        summary["wall"] = clocks.get("wall", np.nan)
+        summary["clock_time"] = clocks.get("clock_time", -1)
+        summary["base_time"] = clocks.get("base_time", -1)
+        summary["wall_minus_running"] = clocks.get("wall_minus_running", np.nan)
+        summary["camera_minus_pts"] = clocks.get("camera_minus_pts", np.nan)
+        self.chunks.append(summary)
+
+    def close(self):
+        "Close both record files."
+        self.frames.close()
+        self.chunks.close()
+
+
+def read_pickle(path):
+    "Return the frames, loss, framerate and clocks stored in a former pickle file."
+    with Path(path).open("rb") as handle:
+        timestamps = pickle.load(handle)
+    loss = timestamps.pop("loss", 0)
+    framerate = timestamps.pop("framerate", None)
+    clocks = timestamps.pop("clocks", {})
+    hardware = timestamps.pop("hardware", None)
+
+    if isinstance(hardware, np.ndarray):
+        frames = np.zeros(len(hardware), dtype=FRAME_DTYPE)
+        for name in hardware.dtype.names:
+            frames[name] = hardware[name]
+        return frames, loss, framerate, clocks
+
+    frame_numbers = sorted(timestamps)
+    frames = np.zeros(len(frame_numbers), dtype=FRAME_DTYPE)
+    frames["frame"] = frame_numbers
+    frames["wall"] = [timestamps[k] for k in frame_numbers]
+    frames["pts"] = frames["dts"] = CLOCK_TIME_NONE
+    frames["running_time"] = frames["camera_time"] = frames["frame_count"] = -1
+    hardware_fields = ["pts", "dts", "running_time", "camera_time", "frame_count"]
+    for i, k in enumerate(frame_numbers):
+        if hardware and k in hardware:
+            for name, value in zip(hardware_fields, hardware[k]):
+                frames[name][i] = value
+    return frames, loss, framerate, clocks
+
+
+def convert_pickles(camera_dir, expected_frames=0, remove=False):
+    "Convert the pickle files of a camera directory to record files, return the number of chunks."
+    camera_dir = Path(camera_dir)
+    pickles = sorted(camera_dir.glob("*.pickle"))
+    if (camera_dir / CHUNKS_FILE).exists() and len(read_chunks(camera_dir)) > 0:
+        raise FileExistsError(f"{camera_dir} already contains record files")
+    writer = TimestampWriter(camera_dir)
+    for chunk_id, path in enumerate(pickles):
+        frames, loss, framerate, clocks = read_pickle(path)
+        writer.write_chunk(chunk_id, frames, expected_frames, loss, framerate, clocks)
+    writer.close()
+    if remove:
+        for path in pickles:
+            path.unlink()
+    return len(pickles)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser("Convert pickle timestamps to record files.")
+    parser.add_argument("camera_dirs", nargs="+",
+                        help="Directories containing the pickle files of a camera",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("-e", "--expected-frames",
+                        help="Expected number of frames per chunk (pwm.chunk_size)",
+                        dest="expected_frames", default=0, type=int)
+    parser.add_argument("--remove",
+                        help="Remove the pickle files after conversion",
+                        dest="remove", action="store_true")
+    args = parser.parse_args()
+
+    for camera_dir in args.camera_dirs:
+        n_chunks = convert_pickles(camera_dir, args.expected_frames, args.remove)
+        print(f"{camera_dir}: converted {n_chunks} chunks")
@@ -0,0 +1,208 @@
+"""
+Per-stage latency tracing with pad probes.
+
+When tracing is enabled, a probe on the src pad of the source and on the
+sink pad of every following element stores the time at which each buffer
+reaches it, buffers being matched by their PTS. The times are kept in a
+fixed-size ring, the complete rows being appended at each chunk to
+TRACE_FILE next to the timestamp files. The time a buffer spends in a
+stage is the difference between its arrival in the element and in the
+next one, so the queue stage is the wait for the encoder and the encoder
+stage includes its push to the writer.
+
+To print the p50/p99 latency of every stage of recorded sessions:
+
+    python -m tiscam.tracing path/to/cam_dir [...] [--per-chunk]
+"""
+import time
+import threading
+import numpy as np
+from pathlib import Path
+
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+from tiscam.timestamps import RecordFile, read_records, CLOCK_TIME_NONE
+
+TRACE_FILE = "trace.tsr"
+
+
+def reaches(pad, name):
+    "Return True if the element named name is linked downstream of a src pad."
+    peer = pad.get_peer()
+    if peer is None:
+        return False
+    element = peer.get_parent_element()
+    return element.get_name() == name or any(reaches(p, name) for p in element.srcpads)
+
+
+def pipeline_chain(pipeline, first="source", through="queue"):
+    """Return the elements linked downstream of the first one, in data flow order.
+
+    At a tee (frame tap, preview), the branch going through the element
+    named through, the recording branch, is followed.
+    """
+    element = pipeline.get_by_name(first)
+    chain = [element]
+    while element.srcpads:
+        pads = [pad for pad in element.srcpads if pad.get_peer() is not None]
+        if not pads:
+            break
+        pad = pads[0] if len(pads) == 1 else next((p for p in pads if reaches(p, through)), pads[0])
+        element = pad.get_peer().get_parent_element()
+        chain.append(element)
+    return chain
+
+
+def stage_names(chain):
+    "Return unique names of the elements, stable when the pipeline is rebuilt."
+    names, bases = [], []
+    for element in chain:
+        name = element.get_name()
+        factory = element.get_factory()
+        if factory is not None:
+            suffix = name[len(factory.get_name()):]
+            if name.startswith(factory.get_name()) and suffix.isdigit():
+                name = factory.get_name()  # Automatic name, e.g. videoconvert3
+        bases.append(name)
+        n = bases.count(name)
+        names.append(name if n == 1 else f"{name}_{n - 1}")
+    return names
+
+
+class Tracer:
+    """Record the time at which each buffer reaches every element of a pipeline.
+
+    :param camera_dir: directory where TRACE_FILE is written
+    :param capacity: number of buffers kept in the ring between two dumps
+    """
+
+    def __init__(self, camera_dir, capacity=4096):
+        "Create the ring, allocated once the pipeline is known."
+        self.path = Path(camera_dir) / TRACE_FILE
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.names = []
+        self.file = None
+        self.chunk_id = 0
+        self.lost = 0
+
+    def attach(self, pipeline, first="source"):
+        "Probe every element of a newly created pipeline."
+        chain = pipeline_chain(pipeline, first)
+        names = stage_names(chain)
+        if names != self.names or self.file is None:
+            self.names = names
+            self.dtype = np.dtype([("chunk", np.int64), ("pts", np.uint64)]
+                                  + [(name, np.int64) for name in names[1:]])
+            if self.file is not None:
+                self.file.close()
+            self.file = RecordFile(self.path, self.dtype)
+        self.times = np.full((self.capacity, len(names)), -1, dtype=np.int64)
+        self.pts = np.full(self.capacity, CLOCK_TIME_NONE, dtype=np.uint64)
+        self.chunks = np.zeros(self.capacity, dtype=np.int64)
+        self.slots = {}
+        self.seq = 0
+
+        chain[0].srcpads[0].add_probe(Gst.PadProbeType.BUFFER, self.on_source_buffer)
+        for point, element in enumerate(chain[1:], 1):
+            element.sinkpads[0].add_probe(Gst.PadProbeType.BUFFER, self.on_buffer, point)
+
+    def on_source_buffer(self, pad, info):
+        "Claim the next slot of the ring for a buffer leaving the source."
+        now = time.perf_counter_ns()
+        pts = info.get_buffer().pts
+        if pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        with self.lock:
+            slot = self.seq % self.capacity
+            self.seq += 1
+            if self.times[slot, 0] >= 0:
+                self.lost += 1  # Not dumped yet, or dropped by an element
+            self.slots.pop(int(self.pts[slot]), None)
+            self.times[slot] = -1
+            self.times[slot, 0] = now
+            self.pts[slot] = pts
+            self.chunks[slot] = self.chunk_id
+            self.slots[pts] = slot
+        return Gst.PadProbeReturn.OK
+
+    def on_buffer(self, pad, info, point):
+        "Store the arrival time of a buffer in an element."
+        slot = self.slots.get(info.get_buffer().pts)
+        if slot is not None:
+            self.times[slot, point] = time.perf_counter_ns()
+        return Gst.PadProbeReturn.OK
+
+    def dump(self):
+        "Append the buffers that went through every element to TRACE_FILE, return their number."
+        if self.file is None:
+            return 0
+        with self.lock:
+            rows = np.flatnonzero(self.times[:, -1] >= 0)
+            rows = rows[np.argsort(self.times[rows, 0])]
+            records = np.zeros(len(rows), dtype=self.dtype)
+            records["chunk"] = self.chunks[rows]
+            records["pts"] = self.pts[rows]
+            for point, name in enumerate(self.names[1:], 1):
+                records[name] = self.times[rows, point] - self.times[rows, 0]
+            self.times[rows] = -1
+        self.file.append(records)
+        return len(records)
+
+    def close(self):
+        "Close TRACE_FILE."
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def stage_latencies(records):
+    "Return {stage: latencies (s)} of trace records, and the total latency as 'total'."
+    names = [name for name in records.dtype.names if name not in ["chunk", "pts"]]
+    arrivals = np.column_stack([np.zeros(len(records))] + [records[n] for n in names]) / 1e9
+    stages = {}
+    for i, name in enumerate(["source"] + names[:-1]):
+        stages[name] = arrivals[:, i + 1] - arrivals[:, i]
+    stages["total"] = arrivals[:, -1]
+    return stages
+
+
+def summarize(records, percentiles=(50, 99)):
+    "Return [(stage, *percentiles, max)] of the stage latencies (ms)."
+    summary = []
+    for stage, latencies in stage_latencies(records).items():
+        if len(latencies) == 0:
+            continue
+        values = np.percentile(latencies, percentiles) * 1e3
+        summary.append((stage, *values, latencies.max() * 1e3))
+    return summary
+
+
+def print_summary(records, title):
+    "Print the p50/p99/max latency of each stage."
+    print(f"{title}: {len(records)} buffers")
+    print(f"    {'stage':<16}{'p50 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}")
+    for stage, p50, p99, maximum in summarize(records):
+        print(f"    {stage:<16}{p50:10.3f}{p99:10.3f}{maximum:10.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("camera_dirs", nargs="+",
+                        help="Camera directories containing a trace file",
+                        type=lambda x: Path(x).expanduser().absolute())
+    parser.add_argument("--per-chunk", help="Summarize each chunk separately",
+                        dest="per_chunk", action="store_true")
+    args = parser.parse_args()
+
+    for camera_dir in args.camera_dirs:
+        records = read_records(camera_dir / TRACE_FILE)
+        if not args.per_chunk:
+            print_summary(records, camera_dir.name)
+            continue
+        for chunk in np.unique(records["chunk"]):
+            print_summary(records[records["chunk"] == chunk], f"{camera_dir.name} chunk {chunk}")